@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Maximum likelihood calibration of the error parameters against the 2018
+backtest (CNalysis ratings merged with results in cnalysis_forecasts_2018.py).
+In each state, the actual D margin of every race is its rating's margin plus
+a statewide shift, density class shifts weighted by the race's density
+proportions, and its own race error, all t-distributed as in the model. The
+likelihood of a state integrates its shifts out with the model's quadrature
+rule (nodes scale with each sigma, so the rule only changes with the degrees
+of freedom), so every race at every node is one vectorized t log-pdf, and the
+gradient with respect to every sigma and the race parameters is analytic.
+The statewide degrees of freedom move the nodes and weights of the rule, so
+their derivative chains the (analytic) derivatives with respect to the nodes
+and weights with a central difference of the rule alone.
+"""
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import gammaln, digamma
+from quadrature import tensor_rule
+from voter_power import rating_to_margin, race_error_parameters
+
+# parameter files read and written
+ERR_PATH = 'data/input/parameters/correlated_error_parameters.csv'
+RACE_ERR_PATH = 'data/input/parameters/race_error_parameters.csv'
+RATING_PATH = 'data/input/parameters/CNalysis_rating_to_margin.csv'
+
+# step (in log degrees of freedom) of the central difference of the rule
+LOG_DEG_F_STEP = 1e-4
+
+
+def backtest_residuals(results_df, rating_to_margin_df, error_vars):
+    ''' Finds how far the actual D margin of each 2018 race was from the
+    margin of its rating.
+
+    Arguments:
+        results_df: DataFrame of chaz_with_election_results.csv
+        rating_to_margin_df: DataFrame of CNalysis_rating_to_margin.csv,
+            indexed by rating
+        error_vars: list of the sources of correlated error ('statewide' and
+            the density proportion columns of results_df)
+    Output: DataFrame of the races used (D or R favored, contested, with
+        densities and not marked to ignore), sorted by state, with columns
+        'state', 'residual' and error_vars
+    '''
+
+    races = results_df[results_df['predicted_winner'].isin(['D', 'R']) &
+                       (results_df['confidence'] != 'Uncontested')]
+    races = races[races['actual_win_margin'].abs() < 1].copy()
+    if 'ignore' in races.columns:
+        races = races[~races['ignore'].isin([True, 'TRUE', 'True'])]
+    races['statewide'] = 1
+    races = races.dropna(subset=list(error_vars))
+
+    # actual and expected D margins (actual_win_margin is the margin of the
+    # predicted winner)
+    sign = np.where(races['predicted_winner'] == 'D', 1, -1)
+    actual = sign * races['actual_win_margin'].astype(float)
+    expected = races.apply(lambda x: rating_to_margin(x['predicted_winner'],
+                                                      x['confidence'],
+                                                      rating_to_margin_df),
+                           axis=1)
+    races['state'] = races['state_po']
+    races['residual'] = actual - expected
+
+    return races.sort_values('state', kind='stable')[
+        ['state', 'residual'] + list(error_vars)].reset_index(drop=True)
+
+
+def standard_rule(deg_fs, nodes):
+    """ Tensor rule (see quadrature.tensor_rule) of the correlated errors with
+    sigma 1, which scales with the sigmas. Not cached, as a fit tries many
+    degrees of freedom.
+    """
+
+    return tensor_rule([((1, deg_f), num_nodes) for deg_f, num_nodes in
+                        zip(deg_fs, nodes)])
+
+
+def log_likelihood(sigmas, shifts, weights, race_sigma, race_deg_f,
+                   residuals, loadings, state_starts, grad=True):
+    ''' Log-likelihood of the backtest, and its gradient.
+
+    Arguments:
+        sigmas: list of the sigma of each source of correlated error
+        shifts, weights: standard_rule output
+        race_sigma, race_deg_f: parameters of the race error
+        residuals: numpy array of the residual of each race (sorted by state)
+        loadings: numpy array, one row per race and one column per source of
+            correlated error (1 for statewide, density proportions)
+        state_starts: numpy array of the first race of each state
+        grad (optional): if True, also find the gradient
+    Output: log-likelihood, and if grad, numpy arrays of its derivatives with
+        respect to each sigma, to (race_sigma, race_deg_f), to shifts and to
+        the log of weights
+    '''
+
+    # race error at every node, and its t log-pdf
+    x = residuals - shifts.dot((loadings * sigmas).T)
+    nu = race_deg_f
+    scale = nu * race_sigma**2
+    u = x**2 / scale
+    log1p_u = np.log1p(u)
+    log_pdf = gammaln((nu + 1) / 2) - gammaln(nu / 2) - \
+        0.5 * np.log(nu * np.pi) - np.log(race_sigma) - (nu + 1) / 2 * log1p_u
+
+    # integrate each state's shifts out
+    node_state = np.add.reduceat(log_pdf, state_starts, axis=1) + \
+        np.log(weights)[:, np.newaxis]
+    peak = np.max(node_state, axis=0)
+    state_ll = peak + np.log(np.sum(np.exp(node_state - peak), axis=0))
+    total = np.sum(state_ll)
+    if not grad:
+        return total
+
+    # posterior weight of each node in each state, spread to its races (they
+    # sum to 1 over the nodes, so constant terms add up to the race count)
+    num_races = len(residuals)
+    state_post = np.exp(node_state - state_ll)
+    counts = np.diff(np.append(state_starts, num_races))
+    post = np.repeat(state_post, counts, axis=1)
+
+    # derivatives of the log-pdf, averaged over the posterior, written with
+    # x**2 / (scale + x**2) = u / (1 + u)
+    frac = 1 / (1 + u)
+    d_node = (nu + 1) / scale * (post * x * frac).dot(loadings)
+    d_sigmas = np.sum(d_node * shifts, axis=0)
+    post_frac = np.vdot(post, u * frac)
+    d_race_sigma = ((nu + 1) * post_frac - num_races) / race_sigma
+    d_race_deg_f = num_races * (0.5 * (digamma((nu + 1) / 2) -
+                                       digamma(nu / 2)) - 1 / (2 * nu)) - \
+        0.5 * np.vdot(post, log1p_u) + (nu + 1) / (2 * nu) * post_frac
+    return total, d_sigmas, np.array([d_race_sigma, d_race_deg_f]), \
+        d_node * sigmas, np.sum(state_post, axis=1)
+
+
+def fit_error_parameters(residuals_df, err_df, race_sigma=0.07, race_deg_f=5,
+                         fit_deg_f=('statewide',), tol=1e-8):
+    ''' Fits the error parameters by maximum likelihood (L-BFGS-B on the logs
+    of the parameters), starting from err_df and the race parameters passed.
+
+    Arguments:
+        residuals_df: backtest_residuals output
+        err_df: DataFrame of correlated_error_parameters.csv
+        race_sigma, race_deg_f (optional): starting race error parameters
+        fit_deg_f (optional): sources of correlated error whose degrees of
+            freedom are fit too (the rest are kept)
+        tol (optional): tolerance of the optimizer
+    Output: DataFrame like err_df with the fitted parameters, (race_sigma,
+        race_deg_f) fitted, and the scipy OptimizeResult
+    '''
+
+    error_vars = list(err_df['parameter'])
+    sigmas = err_df['sigma'].to_numpy(dtype=float)
+    deg_fs = err_df['deg_f'].to_numpy(dtype=float)
+    nodes = err_df['nodes'].to_numpy(dtype=int)
+    deg_f_ix = [error_vars.index(var) for var in fit_deg_f]
+    residuals = residuals_df['residual'].to_numpy(dtype=float)
+    loadings = residuals_df[error_vars].to_numpy(dtype=float)
+    states = residuals_df['state'].to_numpy()
+    state_starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]])
+    num_sigmas = len(sigmas)
+
+    def unpack(theta):
+        params = np.exp(theta)
+        new_deg_fs = deg_fs.copy()
+        new_deg_fs[deg_f_ix] = params[num_sigmas + 2:]
+        return params[:num_sigmas], new_deg_fs, params[num_sigmas:
+                                                       num_sigmas + 2]
+
+    def objective(theta):
+        new_sigmas, new_deg_fs, race = unpack(theta)
+        shifts, weights = standard_rule(new_deg_fs, nodes)
+        ll, d_sigmas, d_race, d_shifts, d_log_weights = log_likelihood(
+            new_sigmas, shifts, weights, *race, residuals, loadings,
+            state_starts)
+
+        # degrees of freedom move the nodes and weights of the rule, which
+        # are differenced (the likelihood's derivatives with respect to them
+        # are exact)
+        d_deg_fs = []
+        for ix in deg_f_ix:
+            rules = []
+            for step in [LOG_DEG_F_STEP, -LOG_DEG_F_STEP]:
+                step_deg_fs = new_deg_fs.copy()
+                step_deg_fs[ix] *= np.exp(step)
+                rules.append(standard_rule(step_deg_fs, nodes))
+            d_deg_fs.append((np.sum(d_shifts * (rules[0][0] - rules[1][0])) +
+                             np.dot(d_log_weights, np.log(rules[0][1]) -
+                                    np.log(rules[1][1]))) /
+                            (2 * LOG_DEG_F_STEP))
+
+        # gradient with respect to the log parameters
+        d_theta = np.concatenate((d_sigmas * new_sigmas, d_race * race,
+                                  d_deg_fs))
+        return -ll, -d_theta
+
+    theta = np.log(np.concatenate((sigmas, [race_sigma, race_deg_f],
+                                   deg_fs[deg_f_ix])))
+    bounds = [(np.log(1e-4), np.log(1))] * (num_sigmas + 1) + \
+        [(np.log(0.5), np.log(200))] * (1 + len(deg_f_ix))
+    result = minimize(objective, theta, jac=True, method='L-BFGS-B',
+                      bounds=bounds, options={'ftol': tol, 'gtol': tol})
+
+    new_sigmas, new_deg_fs, race = unpack(result.x)
+    fitted_df = err_df.copy()
+    fitted_df['sigma'] = new_sigmas
+    fitted_df['deg_f'] = new_deg_fs
+    return fitted_df, tuple(race), result
+
+
+def main():
+    # read in the backtest (written by cnalysis_forecasts_2018.py) and the
+    # current parameters
+    money_path = "G:/Shared drives/princeton_gerrymandering_project/Moneyball/"
+    results_df = pd.read_csv(money_path +
+                             'chaz/chaz_with_election_results.csv')
+    err_df = pd.read_csv(ERR_PATH)
+    race_sigma, race_deg_f = race_error_parameters(RACE_ERR_PATH)
+    rating_to_margin_df = pd.read_csv(RATING_PATH, index_col='RATING')
+
+    # fit, starting from the current parameters
+    residuals_df = backtest_residuals(results_df, rating_to_margin_df,
+                                      err_df['parameter'])
+    fitted_df, (race_sigma, race_deg_f), result = fit_error_parameters(
+        residuals_df, err_df, race_sigma, race_deg_f)
+    print(result.message)
+    print(fitted_df)
+    print('race sigma', race_sigma, 'race deg_f', race_deg_f)
+
+    # write the fitted parameters (degrees of freedom are as of election eve,
+    # before any time decay), which redistricting_moneyball.py reads
+    fitted_df.to_csv(ERR_PATH, index=False)
+    pd.DataFrame({'parameter': ['race'], 'sigma': [race_sigma],
+                  'deg_f': [race_deg_f]}).to_csv(RACE_ERR_PATH, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled (Numba) kernels for the hot loop of voter_power: interpolating win
+probabilities from tcdf, the probability of D power in a chamber, and the
+loop over quadrature nodes of chamber_success_prob, fused so that no
+(nodes x races) arrays are built. Numba is optional: without it, voter_power
+uses its NumPy code, and the kernels here can still be run uncompiled (the
+'python' backend, slow but useful to check them against NumPy). The 'python'
+backend runs copies of the kernels made before they are compiled, which call
+each other uncompiled too.
+
+The kernels find the probability of D power with the windowed recursion of
+voter_power.chamber_tail_prob_windowed, so they agree with every seat method
+to rounding error; check_backends compares the two backends.
+"""
+import types
+import numpy as np
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    numba = None
+    NUMBA_AVAILABLE = False
+
+BACKENDS = ['auto', 'numba', 'numpy', 'python']
+
+
+def resolve_backend(backend):
+    """ Backend to use: 'auto' is 'numba' when Numba is importable and
+    'numpy' otherwise.
+    """
+
+    assert backend in BACKENDS, backend
+    if backend == 'auto':
+        return 'numba' if NUMBA_AVAILABLE else 'numpy'
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        raise ImportError("the 'numba' backend needs numba installed")
+    return backend
+
+
+def _interp_prob(x, tcdf):
+    """ Win probability at standardized margin x, interpolated from tcdf as
+    in voter_power.probs_from_margins (NaN if tcdf does not cover x).
+    """
+
+    ix = (x + 50) / 100 * (len(tcdf) - 1)
+    if not (ix >= 0 and ix < len(tcdf) - 1):
+        return np.nan
+    floor_ix = int(np.floor(ix))
+    frac_ix = ix - floor_ix
+    return (1 - frac_ix) * tcdf[floor_ix] + frac_ix * tcdf[floor_ix + 1]
+
+
+def _interp_probs(x, tcdf):
+    """ _interp_prob of every element of the 1-D array x. """
+
+    probs = np.empty(len(x))
+    for i in range(len(x)):
+        probs[i] = _interp_prob(x[i], tcdf)
+    return probs
+
+
+def _tail_prob(probs, threshold, tie, window):
+    """ Probability of D power from one node's win probabilities, with the
+    recursion of voter_power.chamber_tail_prob_windowed (window is scratch
+    space of length threshold + 1).
+    """
+
+    num_races = len(probs)
+    window[:] = 0
+    window[0] = 1
+    won = 0.0
+    for k in range(num_races):
+        p = probs[k]
+        won += window[threshold] * p
+
+        # update (in place, from the top) the seat counts that can still end
+        # on the threshold
+        low = max(0, threshold - (num_races - k - 1))
+        high = min(k + 1, threshold)
+        for j in range(high, low - 1, -1):
+            below = window[j - 1] if j > 0 else 0.0
+            window[j] = window[j] * (1 - p) + below * p
+
+    return won + tie * window[threshold]
+
+
+def _tail_probs(probs, threshold, tie):
+    """ _tail_prob of every row of the 2-D array probs. """
+
+    dem_prob = np.empty(probs.shape[0])
+    for i in range(probs.shape[0]):
+        window = np.empty(threshold + 1)
+        dem_prob[i] = _tail_prob(probs[i], threshold, tie, window)
+    return dem_prob
+
+
+def _chamber_dem_prob(design_row, parameter_weights, start, stop, threshold,
+                      tie, fixed, race_sigma, tcdf, probs, window):
+    """ Probability of D power in one chamber at one node (fixed is the
+    probability if the chamber is not in question, -1 if it is). Returns -1
+    if a margin is out of the range of tcdf.
+    """
+
+    if fixed >= 0:
+        return fixed
+    for r in range(start, stop):
+        margin = 0.0
+        for j in range(len(design_row)):
+            margin += design_row[j] * parameter_weights[r, j]
+        prob = _interp_prob(margin / race_sigma, tcdf)
+        if np.isnan(prob):
+            return -1.0
+        probs[r - start] = prob
+    return _tail_prob(probs[:stop - start], threshold, tie, window)
+
+
+def _node_success(design, parameter_weights, chamber_2_ix, threshold_1,
+                  threshold_2, tie_1, tie_2, fixed_1, fixed_2, race_sigma,
+                  tcdf, both_bad, neither_bad):
+    """ Probability of success at every node (row of design), NaN at nodes
+    with a margin out of the range of tcdf.
+    """
+
+    num_races = parameter_weights.shape[0]
+    success = np.empty(design.shape[0])
+    for i in _node_range(design.shape[0]):
+        probs = np.empty(num_races)
+        window = np.empty(max(threshold_1, threshold_2) + 1)
+        dem_1 = _chamber_dem_prob(design[i], parameter_weights, 0,
+                                  chamber_2_ix, threshold_1, tie_1, fixed_1,
+                                  race_sigma, tcdf, probs, window)
+        dem_2 = _chamber_dem_prob(design[i], parameter_weights, chamber_2_ix,
+                                  num_races, threshold_2, tie_2, fixed_2,
+                                  race_sigma, tcdf, probs, window)
+        if dem_1 < 0 or dem_2 < 0:
+            success[i] = np.nan
+        else:
+            success[i] = 1 - both_bad * dem_1 * dem_2 - \
+                neither_bad * (1 - dem_1) * (1 - dem_2)
+    return success
+
+
+def _uncompiled(funcs):
+    """ Copies of the kernels in funcs that find each other (and _node_range)
+    in a namespace of their own, so that they keep calling the plain Python
+    versions once the module's kernels are compiled.
+    """
+
+    namespace = dict(globals())
+    namespace['_node_range'] = range
+    for func in funcs:
+        namespace[func.__name__] = types.FunctionType(
+            func.__code__, namespace, func.__name__, func.__defaults__)
+    return {func.__name__: namespace[func.__name__] for func in funcs}
+
+
+# the 'python' backend, built before the kernels are compiled
+_PYTHON_KERNELS = _uncompiled([_interp_prob, _interp_probs, _tail_prob,
+                               _tail_probs, _chamber_dem_prob, _node_success])
+
+# compile the kernels if Numba is available (nodes are spread over threads
+# with prange); otherwise they run as plain Python
+if NUMBA_AVAILABLE:
+    _node_range = numba.prange
+    _interp_prob = numba.njit(cache=True)(_interp_prob)
+    _interp_probs = numba.njit(cache=True)(_interp_probs)
+    _tail_prob = numba.njit(cache=True)(_tail_prob)
+    _tail_probs = numba.njit(cache=True)(_tail_probs)
+    _chamber_dem_prob = numba.njit(cache=True)(_chamber_dem_prob)
+    _compiled_node_success = numba.njit(cache=True, parallel=True)(
+        _node_success)
+else:
+    _node_range = range
+    _compiled_node_success = None
+
+
+def _kernel(backend, func, compiled_func=None):
+    """ The compiled or plain Python version of a kernel. """
+
+    if backend == 'python':
+        return _PYTHON_KERNELS[getattr(func, 'py_func', func).__name__]
+    return compiled_func or func
+
+
+def compiled_probs_from_margins(margins, race_sigma, tcdf, backend='numba'):
+    """ Win probabilities interpolated from tcdf, as in
+    voter_power.probs_from_margins, NaN where tcdf does not cover a margin.
+    """
+
+    margins = np.asarray(margins, dtype=float)
+    x = np.ascontiguousarray(margins.ravel() / race_sigma)
+    kernel = _kernel(backend, _interp_probs)
+    return kernel(x, np.asarray(tcdf)).reshape(margins.shape)
+
+
+def compiled_tail_probs(probs, threshold, tie, backend='numba'):
+    """ Probability of D power from win probabilities (the last axis indexes
+    races), as in voter_power.chamber_tail_prob_windowed.
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    flat = np.ascontiguousarray(probs.reshape(-1, probs.shape[-1]))
+    kernel = _kernel(backend, _tail_probs)
+    return kernel(flat, int(threshold), float(tie)).reshape(probs.shape[:-1])
+
+
+def compiled_node_success_probs(parameter_weights, design, threshold_1,
+                                threshold_2, tie_1, tie_2, chamber_2_ix,
+                                race_sigma, both_bad, neither_bad, tcdf,
+                                backend='numba'):
+    """ Probability of success at every node (row of design, see
+    quadrature.QuadratureRule), as in voter_power.node_success_probs, NaN at
+    nodes where tcdf does not cover a margin.
+    """
+
+    # code chambers that are not in question by their fixed probability of D
+    # power
+    chambers = []
+    for threshold, tie in [(threshold_1, tie_1), (threshold_2, tie_2)]:
+        if threshold in ['D', 'R']:
+            chambers.append((0, 0.0, float(threshold == 'D')))
+        else:
+            chambers.append((int(threshold), float(tie), -1.0))
+
+    kernel = _kernel(backend, _node_success, _compiled_node_success)
+    return kernel(np.ascontiguousarray(design, dtype=float),
+                  np.ascontiguousarray(parameter_weights, dtype=float),
+                  int(chamber_2_ix), chambers[0][0], chambers[1][0],
+                  chambers[0][1], chambers[1][1], chambers[0][2],
+                  chambers[1][2], float(race_sigma), np.asarray(tcdf),
+                  float(both_bad), float(neither_bad))
+
+
+def check_backends(backend='auto', num_nodes=50, num_races=(30, 40), seed=0,
+                   tol=1e-12):
+    ''' Checks that a compiled backend agrees with NumPy on a random state,
+    failing if any probability differs by more than tol.
+
+    Arguments:
+        backend (optional): backend to check against 'numpy' ('auto' checks
+            'numba' if it is installed and the uncompiled kernels otherwise)
+        num_nodes (optional): number of random nodes
+        num_races (optional): number of races in each chamber
+        seed (optional): seed of the random number generator
+        tol (optional): largest difference allowed
+    Output: dictionary of the largest difference found in the win
+        probabilities, the probabilities of D power and the probabilities of
+        success
+    '''
+
+    # imported here, as voter_power imports this module
+    import voter_power as vp
+    from tcdf_cache import calculate_tcdf
+
+    backend = resolve_backend(backend)
+    if backend == 'numpy':
+        backend = 'python'
+    rng = np.random.default_rng(seed)
+    tcdf = calculate_tcdf(5, 100001)
+    race_sigma = 0.07
+
+    # a random state: margins, sensitivity to 3 sources of error, and nodes
+    chamber_2_ix = num_races[0]
+    parameter_weights = np.column_stack((
+        rng.normal(0, 0.15, sum(num_races)), np.ones(sum(num_races)),
+        rng.random((sum(num_races), 2))))
+    design = np.column_stack((np.ones(num_nodes),
+                              rng.normal(0, 0.05, (num_nodes, 3))))
+    margins = design.dot(parameter_weights.T)
+    thresholds = [num_races[0] // 2, num_races[1] * 2 // 3]
+
+    diffs = {}
+    probs = vp.probs_from_margins(margins, race_sigma, 5, tcdf,
+                                  backend='numpy')
+    diffs['probs'] = np.max(np.abs(
+        compiled_probs_from_margins(margins, race_sigma, tcdf, backend) -
+        probs))
+    diffs['dem_prob'] = np.max(np.abs(
+        compiled_tail_probs(probs[:, :chamber_2_ix], thresholds[0], 0.5,
+                            backend) -
+        vp.chamber_tail_prob(vp.seat_distribution(probs[:, :chamber_2_ix]),
+                             thresholds[0], 0.5)))
+    diffs['success'] = 0
+    for codes in [thresholds, ['D', thresholds[1]], [thresholds[0], 'R']]:
+        for both_bad, neither_bad in [(1, 1), (0, 1), (1, 0)]:
+            args = (*codes, 0.5, 0.3, chamber_2_ix, race_sigma)
+            compiled = compiled_node_success_probs(
+                parameter_weights, design, *args, both_bad, neither_bad, tcdf,
+                backend)
+            exact = vp.node_success_probs(parameter_weights, design[:, 1:],
+                                          *args, 5, both_bad, neither_bad,
+                                          tcdf, backend='numpy')
+            diffs['success'] = max(diffs['success'],
+                                   np.max(np.abs(compiled - exact)))
+
+    assert max(diffs.values()) <= tol, diffs
+    return diffs
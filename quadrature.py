@@ -0,0 +1,465 @@
+"""Quadrature rules for integrating over the correlated (t-distributed) errors.
+
+Every rule here is built from the same one-dimensional rule that
+voter_power.chamber_success_prob has always used: Chebyshev nodes of the
+percentile function of each t-distribution, weighted by the pdf. The full
+tensor product of these rules grows exponentially with the number of sources
+of correlated error, so we also offer Smolyak sparse grids and a
+dimension-adaptive version that refines only the error variables that matter.
+These are built from nested Chebyshev nodes whose number doubles from level
+to level, and by default weight them by the pdf too, so they converge to the
+same value as the rule of chamber_success_prob does as its nodes are added.
+"""
+import warnings
+import scipy.stats as sts
+import numpy as np
+import itertools as it
+from functools import lru_cache
+from scipy.integrate import quad
+from scipy.special import comb
+
+
+def percentile_nodes(sigma, deg_f, num_nodes, weighting='pdf'):
+    """ Chebyshev nodes of the percentile function of a t-distribution and the
+    weight of each node.
+
+    Arguments:
+        sigma: positive real number, scale of the t-distribution
+        deg_f: positive real number, degrees of freedom of the t-distribution
+        num_nodes: number of nodes
+        weighting (optional): 'pdf' weights each node by the pdf (the rule
+            chamber_success_prob has always used), 'fejer' uses Fejer's first
+            rule on the percentiles, which converges to the expectation under
+            the t-distribution itself as nodes are added
+    Output: numpy array of points, numpy array of weights (unnormalized for
+        'pdf', summing to 1 for 'fejer')
+    """
+
+    # get percentiles of nodes (each angle as a fraction of pi in lowest
+    # terms, so that rules whose nodes nest share them exactly)
+    odd = 2 * np.arange(1, num_nodes + 1) - 1
+    gcd = np.gcd(odd, 2 * num_nodes)
+    angles = (odd // gcd) * np.pi / (2 * num_nodes // gcd)
+    nodes = np.cos(angles)
+    nodes = (1 + nodes)/2
+
+    # get points and distribution pdfs to weight all points
+    points = sts.t.ppf(nodes, deg_f, scale=sigma)
+    if weighting == 'pdf':
+        weights = sts.t.pdf(points, deg_f, scale=sigma)
+    else:
+        j = np.arange(1, num_nodes // 2 + 1)
+        weights = 1 - 2 * np.sum(np.cos(2 * np.outer(angles, j)) /
+                                 (4 * j**2 - 1), axis=1)
+        weights = weights / num_nodes
+    return points, weights
+
+
+def level_nodes(level):
+    """ Number of nodes in the one-dimensional rule of a given level (3, 7,
+    15, 31, ...), see nested_nodes. Starting from a single node at the median
+    would be cheaper, but it is so far off that the differences between
+    levels that sparse grids are built from stop being small.
+    """
+
+    return 2**(level + 1) - 1
+
+
+def nested_nodes(sigma, deg_f, level, weighting='pdf'):
+    """ One-dimensional rule of a level of the sparse grids: the interior
+    Chebyshev extrema of the percentile function of a t-distribution (the
+    nodes of Fejer's second rule), which are nested as their number doubles,
+    so every level reuses the nodes of the one below.
+
+    With the percentile written as (1 + cos(angle)) / 2, the pdf weighted rule
+    of percentile_nodes is the midpoint rule in the angle, and these nodes
+    with pdf weights are the trapezoid rule of the same integral (the pdf
+    vanishes at the ends), so both converge to the same value.
+
+    Arguments:
+        sigma: positive real number, scale of the t-distribution
+        deg_f: positive real number, degrees of freedom of the t-distribution
+        level: positive integer, level of the rule (see level_nodes)
+        weighting (optional): 'pdf' weights each node by the pdf, converging
+            to what the pdf weighted rule of chamber_success_prob converges
+            to, 'fejer' uses Fejer's second rule on the percentiles, which
+            converges to the expectation under the t-distribution itself
+    Output: numpy array of points, numpy array of weights (unnormalized for
+        'pdf', summing to 1 for 'fejer')
+    """
+
+    # get percentiles of nodes (each angle as a fraction of pi in lowest
+    # terms, so that nested nodes are the same in every level)
+    intervals = level_nodes(level) + 1
+    k = np.arange(1, intervals)
+    gcd = np.gcd(k, intervals)
+    angles = (k // gcd) * np.pi / (intervals // gcd)
+    nodes = (1 + np.cos(angles))/2
+
+    points = sts.t.ppf(nodes, deg_f, scale=sigma)
+    if weighting == 'pdf':
+        weights = sts.t.pdf(points, deg_f, scale=sigma)
+    else:
+        j = np.arange(1, intervals // 2 + 1)
+        weights = 2 / intervals * np.sin(angles) * np.sum(
+            np.sin(np.outer(angles, 2 * j - 1)) / (2 * j - 1), axis=1)
+    return points, weights
+
+
+@lru_cache(maxsize=None)
+def _pdf_weighted_norm(deg_f):
+    """ Integral over the angle of the pdf of a standard t-distribution at the
+    percentile (1 + cos(angle)) / 2 (see pdf_weighted_density).
+    """
+
+    return quad(lambda angle: sts.t.pdf(sts.t.ppf((1 + np.cos(angle)) / 2,
+                                                  deg_f), deg_f), 0, np.pi)[0]
+
+
+def pdf_weighted_density(x, sigma, deg_f):
+    """ Density of the distribution that the pdf weighted rule of
+    percentile_nodes converges to as nodes are added, which is what
+    chamber_success_prob integrates over. The rule is the midpoint rule in the
+    angle of the percentile (1 + cos(angle)) / 2, weighted by the pdf, so in
+    terms of x the density is pdf(x)^2 / sqrt(cdf(x) * (1 - cdf(x))), scaled
+    to integrate to 1. It has lighter tails than the t-distribution itself.
+    """
+
+    z = np.asarray(x, dtype=float) / sigma
+    pdf = sts.t.pdf(z, deg_f)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = pdf**2 / np.sqrt(sts.t.cdf(z, deg_f) * sts.t.sf(z, deg_f))
+    return np.nan_to_num(density) / (_pdf_weighted_norm(deg_f) * sigma)
+
+
+def pdf_weighted_draws(rng, sigma, deg_f, num_draws):
+    """ Draws from pdf_weighted_density: angles are drawn uniformly and kept
+    with probability pdf / pdf(0) (the pdf peaks at 0), about half of them.
+
+    Arguments:
+        rng: numpy random Generator
+        sigma: positive real number, scale of the t-distribution
+        deg_f: positive real number, degrees of freedom of the t-distribution
+        num_draws: number of draws
+    Output: numpy array of draws
+    """
+
+    peak = sts.t.pdf(0, deg_f)
+    draws = []
+    num_left = num_draws
+    while num_left > 0:
+        angles = np.pi * rng.random(2 * num_left + 16)
+        z = sts.t.ppf((1 + np.cos(angles)) / 2, deg_f)
+        keep = z[rng.random(len(z)) * peak < sts.t.pdf(z, deg_f)][:num_left]
+        draws.append(keep)
+        num_left -= len(keep)
+    return sigma * np.concatenate(draws)
+
+
+def tensor_rule(t_dist_params, levels=None, weighting='pdf'):
+    """ Tensor product of the one-dimensional rules of each random variable.
+
+    Arguments:
+        t_dist_params: list of ((sigma, deg_f), nodes) for the t-distributed
+            random variables
+        levels (optional): list with the level of each one-dimensional rule
+            of the sparse grids (see nested_nodes); if not passed, the rules
+            of percentile_nodes with the number of nodes in t_dist_params
+            are used
+        weighting (optional): weighting of the one-dimensional rules (see
+            percentile_nodes and nested_nodes)
+    Output: numpy array of shift vectors (one row per node, one column per
+        random variable), numpy array of their weights (summing to 1)
+    """
+
+    points = []
+    weights = []
+    for ix, ((sigma, deg_f), num_nodes) in enumerate(t_dist_params):
+        if levels is None:
+            pts, wts = percentile_nodes(sigma, deg_f, num_nodes, weighting)
+        else:
+            pts, wts = nested_nodes(sigma, deg_f, levels[ix], weighting)
+        points.append(pts)
+        weights.append(wts / np.sum(wts))
+
+    shifts = np.asarray(list(it.product(*points)))
+    shift_weights = np.asarray([np.prod(i) for i in it.product(*weights)])
+    return shifts, shift_weights
+
+
+class QuadratureRule():
+    """ Nodes and weights for integrating over the correlated errors, stored
+    as contiguous read-only arrays so one rule can be shared by every call
+    that needs it.
+
+    Attributes:
+        shifts: numpy array of shift vectors, one row per node and one column
+            per source of correlated error
+        design: numpy array of shifts with a column of ones prepended, so
+            that design.dot(parameter_weights.T) gives the margins of every
+            race at every node
+        weights: numpy array of the weight of each node, normalized to sum
+            to 1
+        t_dist_params: the ((sigma, deg_f), nodes) the rule was built from
+            (None for rules built from arbitrary nodes)
+    """
+
+    def __init__(self, shifts, weights, t_dist_params=None):
+        shifts = np.array(shifts, dtype=float, ndmin=2, order='C')
+        weights = np.array(weights, dtype=float, order='C')
+        weights /= np.sum(weights)
+        design = np.ascontiguousarray(np.hstack((np.ones((len(shifts), 1)),
+                                                 shifts)))
+        for array in [shifts, weights, design]:
+            array.setflags(write=False)
+
+        self.shifts = shifts
+        self.weights = weights
+        self.design = design
+        self.t_dist_params = t_dist_params
+
+    def __len__(self):
+        return len(self.weights)
+
+
+@lru_cache(maxsize=None)
+def _cached_tensor_rule(t_dist_params):
+    """ Tensor rule of hashable t_dist_params, cached (see quadrature_rule).
+    """
+
+    shifts, weights = tensor_rule(t_dist_params)
+    return QuadratureRule(shifts, weights, t_dist_params)
+
+
+def quadrature_rule(t_dist_params):
+    """ Gets the tensor rule (pdf weighting, as always used by
+    chamber_success_prob) for a list of ((sigma, deg_f), nodes). Rules are
+    cached by these parameters, so states (and perturbed districts) with the
+    same correlated errors share one rule.
+
+    Arguments:
+        t_dist_params: list of ((sigma, deg_f), nodes) for the t-distributed
+            random variables, e.g. list(error_vars.values())
+    Output: QuadratureRule
+    """
+
+    key = tuple(((float(sigma), float(deg_f)), int(nodes))
+                for (sigma, deg_f), nodes in t_dist_params)
+    return _cached_tensor_rule(key)
+
+
+def _merge_nodes(rules):
+    """ Combines a list of (coefficient, shifts, weights) into one rule,
+    adding up the weights of nodes that appear in more than one rule.
+    """
+
+    merged = {}
+    for coef, shifts, weights in rules:
+        for shift, weight in zip(map(tuple, shifts), weights):
+            merged[shift] = merged.get(shift, 0) + coef * weight
+    shifts = np.asarray(list(merged.keys()))
+    weights = np.asarray(list(merged.values()))
+    return shifts, weights
+
+
+def smolyak_rule(t_dist_params, level, weighting='pdf'):
+    """ Smolyak sparse grid built from the one-dimensional rules, using the
+    combination technique. Level 0 is the tensor product of the three node
+    rules (see level_nodes); above it, the number of nodes grows polynomially
+    rather than exponentially with the number of random variables.
+
+    Arguments:
+        t_dist_params: list of ((sigma, deg_f), nodes) for the t-distributed
+            random variables (the number of nodes is ignored)
+        level: non-negative integer, level of the sparse grid
+        weighting (optional): weighting of the one-dimensional rules (see
+            nested_nodes)
+    Output: numpy array of shift vectors, numpy array of their weights (some
+        may be negative, they sum to 1)
+    """
+
+    dim = len(t_dist_params)
+    assert dim > 0, "no correlated error encoded"
+    q = level + dim
+
+    # sum tensor rules with |levels| between q - dim + 1 and q
+    rules = []
+    for levels in it.product(range(1, level + 2), repeat=dim):
+        size = sum(levels)
+        if size < max(dim, q - dim + 1) or size > q:
+            continue
+        coef = (-1)**(q - size) * comb(dim - 1, q - size, exact=True)
+        shifts, weights = tensor_rule(t_dist_params, levels, weighting)
+        rules.append((coef, shifts, weights))
+
+    return _merge_nodes(rules)
+
+
+class _CachedIntegrand():
+    """ Wraps an integrand so that each node is evaluated only once, and keeps
+    count of the evaluations.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.values = {}
+
+    def __call__(self, shifts):
+        keys = list(map(tuple, shifts))
+        new = [i for i, key in enumerate(keys) if key not in self.values]
+        if new:
+            new_values = self.func(shifts[new])
+            for i, value in zip(new, new_values):
+                self.values[keys[i]] = value
+        return np.asarray([self.values[key] for key in keys])
+
+    @property
+    def evaluations(self):
+        return len(self.values)
+
+
+def _check_converged(error, tol):
+    """ Whether an error estimate met tol, warning if it did not. """
+
+    if error <= tol:
+        return True
+    warnings.warn('estimated error {:.2g} is above tol {:.2g}, raise the '
+                  'highest level or number of evaluations'.format(error, tol),
+                  RuntimeWarning)
+    return False
+
+
+def smolyak_integrate(func, t_dist_params, tol, max_level=6,
+                      weighting='pdf'):
+    """ Integrates a function of the correlated errors on Smolyak sparse grids
+    of increasing level, until two successive levels agree to within tol.
+
+    Arguments:
+        func: function taking a numpy array of shift vectors (one row per
+            node) and returning a numpy array with the value at each node
+        t_dist_params: list of ((sigma, deg_f), nodes) for the t-distributed
+            random variables
+        tol: requested absolute error
+        max_level (optional): highest level to try
+        weighting (optional): weighting of the one-dimensional rules (see
+            nested_nodes)
+    Output: dictionary with the estimate ('prob'), the estimated absolute
+        error ('error'), whether it met tol ('converged', a warning is
+        raised if not), the number of distinct nodes evaluated
+        ('evaluations'), the final level ('level') and the final rule
+        ('shifts', 'weights')
+    """
+
+    integrand = _CachedIntegrand(func)
+    prev = None
+    for level in range(max_level + 1):
+        shifts, weights = smolyak_rule(t_dist_params, level, weighting)
+        value = weights.dot(integrand(shifts))
+        error = np.inf if prev is None else abs(value - prev)
+        if error <= tol:
+            break
+        prev = value
+
+    converged = _check_converged(error, tol)
+    return {'prob': value, 'error': error, 'converged': converged,
+            'evaluations': integrand.evaluations, 'level': level,
+            'shifts': shifts, 'weights': weights}
+
+
+def adaptive_integrate(func, t_dist_params, tol, max_evals=100000,
+                       max_level=7, weighting='pdf'):
+    """ Integrates a function of the correlated errors with a
+    dimension-adaptive sparse grid (Gerstner and Griebel): starting from the
+    tensor product of the three node rules, keep refining the one-dimensional rule whose refinement changed
+    the estimate the most, until the sum of the latest changes (the error
+    estimate) is below tol.
+
+    Arguments:
+        func: function taking a numpy array of shift vectors (one row per
+            node) and returning a numpy array with the value at each node
+        t_dist_params: list of ((sigma, deg_f), nodes) for the t-distributed
+            random variables
+        tol: requested absolute error
+        max_evals (optional): stop once this many nodes have been evaluated
+        max_level (optional): highest level of any one-dimensional rule
+        weighting (optional): weighting of the one-dimensional rules (see
+            nested_nodes)
+    Output: dictionary with the estimate ('prob'), the estimated absolute
+        error ('error'), whether it met tol ('converged', a warning is
+        raised if not), the number of distinct nodes evaluated
+        ('evaluations'), the level of each one-dimensional rule reached
+        ('levels') and the final rule ('shifts', 'weights')
+    """
+
+    dim = len(t_dist_params)
+    assert dim > 0, "no correlated error encoded"
+    integrand = _CachedIntegrand(func)
+    tensors = {}
+
+    def tensor(levels):
+        # tensor rule with these levels, and its estimate
+        if levels not in tensors:
+            shifts, weights = tensor_rule(t_dist_params, levels,
+                                          weighting)
+            tensors[levels] = (shifts, weights,
+                               weights.dot(integrand(shifts)))
+        return tensors[levels]
+
+    def difference(levels):
+        # change in the estimate from adding this index (tensor product of
+        # one-dimensional differences), as a list of (coefficient, levels)
+        terms = []
+        for drop in it.product([0, 1], repeat=dim):
+            lower = tuple(l - d for l, d in zip(levels, drop))
+            if min(lower) > 0:
+                terms.append(((-1)**sum(drop), lower))
+        return terms
+
+    def contribution(levels):
+        return sum(coef * tensor(lower)[2]
+                   for coef, lower in difference(levels))
+
+    start = (1,) * dim
+    old = set()
+    active = {start: contribution(start)}
+    while True:
+        error = sum(abs(value) for value in active.values())
+        if error <= tol or integrand.evaluations >= max_evals:
+            break
+
+        # refine the index with the largest change
+        levels = max(active, key=lambda key: abs(active[key]))
+        last_change = abs(active.pop(levels))
+        old.add(levels)
+        for i in range(dim):
+            new = levels[:i] + (levels[i] + 1,) + levels[i + 1:]
+            if new[i] > max_level or new in active:
+                continue
+
+            # only admissible if all its backward neighbors are done
+            if all(new[:j] + (new[j] - 1,) + new[j + 1:] in old
+                   for j in range(dim) if new[j] > 1):
+                active[new] = contribution(new)
+
+        # nothing left to refine (every rule is at max_level)
+        if not active:
+            error = last_change
+            break
+
+    # combine the tensor rules of every index into one rule
+    indices = old | set(active)
+    coefs = {}
+    for levels in indices:
+        for coef, lower in difference(levels):
+            coefs[lower] = coefs.get(lower, 0) + coef
+    rules = [(coef,) + tensor(lower)[:2] for lower, coef in coefs.items()
+             if coef != 0]
+    shifts, weights = _merge_nodes(rules)
+
+    converged = _check_converged(error, tol)
+    return {'prob': sum(contribution(levels) for levels in indices),
+            'error': error, 'converged': converged,
+            'evaluations': integrand.evaluations,
+            'levels': tuple(max(levels[i] for levels in indices)
+                            for i in range(dim)),
+            'shifts': shifts, 'weights': weights}
@@ -5,170 +5,248 @@ Created on Fri Jul 24 13:08:40 2020
 @author: Jacob
 """
 
+import os
 import pandas as pd
-import numpy as np
 from datetime import date
-from voter_power import state_voter_powers
-import scipy.stats as sts
-
-
-# set update date and election date
-last_update = date(2020, 10, 10)
-election_day = date(2020, 11, 3)
-days_to_election = (election_day - last_update).days
-
-# get current month, day, year for file saving
-today = date.today()
-datestring = '_' + str(today.month) + '_' + str(today.day) + '_' + \
-                        str(today.year)
-
-# read in input DataFrame
-races_df = pd.read_csv('data/output/CNalysis/all_input_data.csv')
-
-# read in and merge foundations margin
-pred_path = 'data/output/foundation/foundations_predictions_2020.csv'
-founds_df = pd.read_csv(pred_path)
-founds_df['office'] = founds_df['chamber']
-founds_df = founds_df[['state', 'district_num', 'office', 'found_margin']]
-races_df = pd.merge(races_df, founds_df, how='left',
-                    on=['state', 'office', 'district_num'])
-
-# nebraska unicameral hack
-races_df.loc[(races_df['state'] == 'DE') &
-             (races_df['office'] == 'lower'), 'state'] = 'NE'
-             
-# read in states to test
-to_test = pd.read_csv('data/input/parameters/states_and_thresholds.csv')
-
-# merge to get thresholds
-races_df = pd.merge(races_df, to_test, how='left', on=['state', 'office'])
-             
-# restrict to chambers where there is a threshold in the csv
-races_df = races_df[races_df['d_threshold'].notna()]
-
-             
-# add column for statewide error
-races_df['statewide'] = 1
-
-# how much should we fatten the tails based on the time to election
-deg_f_scale = 1 + min(1, 1/4*np.log(1 + days_to_election/20))
-
-# set the correlated error vars
-error_vars = {}
-err_df = pd.read_csv('data/input/parameters/correlated_error_parameters.csv')
-for _, row in err_df.iterrows():
-    sigma = row['sigma']
-    deg_f = row['deg_f']
-    if row['decay']:
-        deg_f /= deg_f_scale
-    error_vars[row['parameter']] = ((sigma, deg_f), row['nodes'])
-
-# set the isolated race error
-race_sigma = 0.07
-race_deg_f = 5 / deg_f_scale
-
-# get t-distribution cdf (bottleneck if not pre-calculated)
-tcdf = sts.t.cdf(np.linspace(-50, 50, 10000000), race_deg_f)
-
-# set DataFrame columns for voter power analysis
-margin_col = 'margin'
-voters_col = 'turnout_estimate'
-threshold_col = 'd_threshold'
-tie_col = 'tie_dem'
-chamber_col = 'office'
-power_col = 'VOTER_POWER'
-
-# read csv into ratings_to_margin DataFrame
-path = 'data/input/parameters/CNalysis_rating_to_margin.csv'
-rating_to_margin_df = pd.read_csv(path, index_col='RATING')
-
-# initialize list of bipartisan control probabilities
-bipart_probs = []
-
-# for each state
-for state in races_df['state'].unique():
-    print(state)
-
-    # find probablity of bipartisan control of residistricting
-
-    # no blending for NC, all Chaz (redistricting since 2018 messes up founds)
-    if state in ['NE', 'NC']:
-        bipart_prob = state_voter_powers(races_df, margin_col, voters_col,
-                                         threshold_col, tie_col, chamber_col,
-                                         power_col, state, error_vars,
-                                         race_sigma, race_deg_f,
-                                         rating_to_margin_df, tcdf,
-                                         prob_only=True)
-    else:
-        bipart_prob = state_voter_powers(races_df, margin_col, voters_col,
-                                         threshold_col, tie_col, chamber_col,
-                                         power_col, state, error_vars,
-                                         race_sigma, race_deg_f,
-                                         rating_to_margin_df, tcdf,
-                                         found_margin_col='found_margin',
-                                         found_clip=0.06,
-                                         blend_safe=0.75, blend_else=0.5,
-                                         prob_only=True)
-
-    bipart_probs.append(bipart_prob)
-
-# write results to DataFrame
-bipartisan_control_df = pd.DataFrame({'state': races_df['state'].unique(),
-                                      'bipartisan_prob': bipart_probs})
-
-# write these DataFrame to a csv
-bipartisan_control_df.to_csv('data/output/voter_power/bipartisan_prob' +
-                             datestring + '.csv', index=False)
-print('win probs done')
-
-results = []
-
-# for each state
-for state in races_df['state'].unique():
-    print('starting ' + state)
+from multiprocessing import Pool
+from voter_power import state_voter_powers, state_options, \
+    time_decay_scale, correlated_error_vars, race_error_parameters
+from state_batch import state_batch_probs
+from sweep import prepare_states
+from timeline import timeline, timeline_dates
+from quadrature import quadrature_rule
+from tcdf_cache import load_tcdf
+
+# number of worker processes (None for one per core, 1 to run serially)
+NUM_PROCESSES = None
+
+# number of threads each state spreads its districts over (worth raising
+# above 1 when one large state takes much longer than the rest)
+STATE_WORKERS = None
+
+# if True, only find the probability of bipartisan control of each state, all
+# states at once in one batch (see state_batch.py), skipping voter powers
+PROBS_ONLY = False
+
+# if set to a date, instead find the probability of bipartisan control of each
+# state as of every day from then to the election (see timeline.py)
+TIMELINE_START = None
+
+# arguments shared by every state, set once in each worker process
+_shared = {}
 
-    # no blending for NC, all CNalysis (maps redrawn in 2018)
-    if state in ['NE', 'NC']:
-        power_df = state_voter_powers(races_df, margin_col, voters_col,
-                                      threshold_col, tie_col, chamber_col,
-                                      power_col, state, error_vars,
-                                      race_sigma, race_deg_f,
-                                      rating_to_margin_df, tcdf)
+
+def init_worker(shared):
+    """ Stores the arguments shared by every state in a worker process. The
+    t cdf table (already cached on disk by main) is opened memory-mapped here
+    rather than sent to the worker, so all workers share one copy of it.
+    """
+
+    _shared.update(shared)
+    _shared['tcdf'] = load_tcdf(shared['race_deg_f'])
+
+
+def run_state(state):
+    """ Runs state_voter_powers for one state in a worker.
+    """
+
+    print('starting ' + state)
+    args = [_shared[i] for i in ['races_df', 'margin_col', 'voters_col',
+                                  'threshold_col', 'tie_col', 'chamber_col',
+                                  'power_col']]
+    args += [state] + [_shared[i] for i in ['error_vars', 'race_sigma',
+                                             'race_deg_f',
+                                             'rating_to_margin_df', 'tcdf']]
+    return state_voter_powers(*args, rule=_shared['rule'],
+                              workers=STATE_WORKERS, **state_options(state))
+
+
+def run_states(states, shared, processes=NUM_PROCESSES):
+    """ Runs every state, spread across a pool of worker processes. States
+    with the most races start first so that the slowest jobs do not hold up
+    the end of the run.
+
+    Arguments:
+        states: list of postal codes of states to run
+        shared: dictionary of the arguments shared by every state (see
+            run_state)
+        processes (optional): number of worker processes (None for one per
+            core, 1 to run in this process)
+    Output: list of the VoterPowerResult of each state, in the order of
+        states
+    """
+
+    # order jobs by number of races, largest first
+    sizes = shared['races_df']['state'].value_counts()
+    order = sorted(states, key=lambda x: -sizes.get(x, 0))
+
+    if processes == 1:
+        init_worker(shared)
+        results = list(map(run_state, order))
     else:
-        power_df = state_voter_powers(races_df, margin_col, voters_col,
-                                      threshold_col, tie_col, chamber_col,
-                                      power_col, state, error_vars,
-                                      race_sigma, race_deg_f,
-                                      rating_to_margin_df, tcdf,
-                                      found_margin_col='found_margin',
-                                      found_clip=0.06,
-                                      blend_safe=0.75, blend_else=0.5)
-
-    # append to results dataframe
-    results.append(power_df)
-    power_df.to_csv('data/output/voter_power/' + state +
-                    datestring + '.csv', index=False)
-
-
-# concatenate statewide dataframes
-output_df = pd.concat(results)
-
-# adjust for number of seats at stake
-seats_df = pd.read_csv('data/input/parameters/cong_dist_proj_2021.csv')
-seats_dict = dict(zip(seats_df['state'], seats_df['cong_proj']))
-redist_col = 'redistricting_voter_power'
-output_df[redist_col] = output_df.apply(lambda x: x['VOTER_POWER'] *
-                                        (seats_dict[x['state']] - 1),
-                                        axis=1)
-
-# save raw output file
-output_df.to_csv('data/output/voter_power/all_results_raw' +
-                 datestring + '.csv', index=False)
-
-# delete unecessary columns
-output_df = output_df[['state', 'district', 'incumbent', 'favored',
-                       'confidence', 'nom_R', 'nom_D', 'nom_I', 'cvap',
-                       'VOTER_POWER', 'redistricting_voter_power']]
-
-output_df.to_csv('data/output/voter_power/all_results' +
-                 datestring + '.csv', index=False)
+        processes = processes or os.cpu_count()
+        with Pool(min(processes, len(order)), init_worker, (shared,)) as pool:
+            results = pool.map(run_state, order, chunksize=1)
+
+    # return results in the original order
+    results = dict(zip(order, results))
+    return [results[state] for state in states]
+
+
+def main():
+    # set update date and election date
+    last_update = date(2020, 10, 10)
+    election_day = date(2020, 11, 3)
+    days_to_election = (election_day - last_update).days
+
+    # get current month, day, year for file saving
+    today = date.today()
+    datestring = '_' + str(today.month) + '_' + str(today.day) + '_' + \
+                            str(today.year)
+
+    # read in input DataFrame
+    races_df = pd.read_csv('data/output/CNalysis/all_input_data.csv')
+
+    # read in and merge foundations margin
+    pred_path = 'data/output/foundation/foundations_predictions_2020.csv'
+    founds_df = pd.read_csv(pred_path)
+    founds_df['office'] = founds_df['chamber']
+    founds_df = founds_df[['state', 'district_num', 'office', 'found_margin']]
+    races_df = pd.merge(races_df, founds_df, how='left',
+                        on=['state', 'office', 'district_num'])
+
+    # nebraska unicameral hack
+    races_df.loc[(races_df['state'] == 'DE') &
+                 (races_df['office'] == 'lower'), 'state'] = 'NE'
+
+    # read in states to test
+    to_test = pd.read_csv('data/input/parameters/states_and_thresholds.csv')
+
+    # merge to get thresholds
+    races_df = pd.merge(races_df, to_test, how='left', on=['state', 'office'])
+
+    # restrict to chambers where there is a threshold in the csv
+    races_df = races_df[races_df['d_threshold'].notna()]
+
+
+    # add column for statewide error
+    races_df['statewide'] = 1
+
+    # how much should we fatten the tails based on the time to election
+    deg_f_scale = time_decay_scale(days_to_election)
+
+    # set the correlated error vars
+    err_path = 'data/input/parameters/correlated_error_parameters.csv'
+    err_df = pd.read_csv(err_path)
+    error_vars = correlated_error_vars(err_df, deg_f_scale)
+
+    # build the quadrature rule over the correlated errors once for all states
+    rule = quadrature_rule(list(error_vars.values()))
+
+    # set the isolated race error, as fit by calibration.py if it has been
+    # run (degrees of freedom before the time decay in base_race_deg_f)
+    race_path = 'data/input/parameters/race_error_parameters.csv'
+    race_sigma, base_race_deg_f = race_error_parameters(race_path)
+    race_deg_f = base_race_deg_f / deg_f_scale
+
+    # calculate (and cache on disk) the t-distribution cdf once here, so
+    # that each worker only memory-maps the file (see init_worker)
+    load_tcdf(race_deg_f)
+
+    # set DataFrame columns for voter power analysis
+    margin_col = 'margin'
+    voters_col = 'turnout_estimate'
+    threshold_col = 'd_threshold'
+    tie_col = 'tie_dem'
+    chamber_col = 'office'
+    power_col = 'VOTER_POWER'
+
+    # read csv into ratings_to_margin DataFrame
+    path = 'data/input/parameters/CNalysis_rating_to_margin.csv'
+    rating_to_margin_df = pd.read_csv(path, index_col='RATING')
+
+    # arguments shared by every state
+    shared = {'races_df': races_df, 'margin_col': margin_col,
+              'voters_col': voters_col, 'threshold_col': threshold_col,
+              'tie_col': tie_col, 'chamber_col': chamber_col,
+              'power_col': power_col, 'error_vars': error_vars,
+              'race_sigma': race_sigma, 'race_deg_f': race_deg_f,
+              'rating_to_margin_df': rating_to_margin_df, 'rule': rule}
+    states = list(races_df['state'].unique())
+
+    # find the probability of bipartisan control as of each day until the
+    # election, in one long table
+    if TIMELINE_START is not None:
+        prepared = prepare_states(races_df, margin_col, threshold_col,
+                                  tie_col, states, rating_to_margin_df,
+                                  {state: state_options(state) for state in
+                                   states})
+        timeline_df = timeline(prepared, err_df,
+                               timeline_dates(TIMELINE_START, election_day),
+                               election_day, margin_col, voters_col,
+                               threshold_col, tie_col, chamber_col, power_col,
+                               race_sigma, base_race_deg_f)
+        timeline_df.to_csv('data/output/voter_power/bipartisan_prob_timeline'
+                           + datestring + '.csv', index=False)
+        print('timeline done')
+        return
+
+    # find only the probability of bipartisan control, in one batch
+    if PROBS_ONLY:
+        bipartisan_control_df = state_batch_probs(
+            races_df, margin_col, threshold_col, tie_col, chamber_col, states,
+            error_vars, race_sigma, race_deg_f, rating_to_margin_df,
+            load_tcdf(race_deg_f), {state: state_options(state) for state in
+                                    states}, rule=rule)
+        bipartisan_control_df.to_csv('data/output/voter_power/'
+                                     'bipartisan_prob' + datestring + '.csv',
+                                     index=False)
+        print('win probs done')
+        return
+
+    # find probablity of bipartisan control of residistricting and voter
+    # powers in each state
+    results = run_states(states, shared)
+    bipart_probs = [result.bipartisan_prob for result in results]
+
+    # write results to DataFrame
+    bipartisan_control_df = pd.DataFrame({'state': states,
+                                          'bipartisan_prob': bipart_probs})
+
+    # write these DataFrame to a csv
+    bipartisan_control_df.to_csv('data/output/voter_power/bipartisan_prob' +
+                                 datestring + '.csv', index=False)
+    print('win probs done')
+
+    # write voter powers in each state
+    power_dfs = [result.districts for result in results]
+    for state, power_df in zip(states, power_dfs):
+        power_df.to_csv('data/output/voter_power/' + state +
+                        datestring + '.csv', index=False)
+
+    # concatenate statewide dataframes
+    output_df = pd.concat(power_dfs)
+
+    # adjust for number of seats at stake
+    seats_df = pd.read_csv('data/input/parameters/cong_dist_proj_2021.csv')
+    seats_dict = dict(zip(seats_df['state'], seats_df['cong_proj']))
+    redist_col = 'redistricting_voter_power'
+    output_df[redist_col] = output_df.apply(lambda x: x['VOTER_POWER'] *
+                                            (seats_dict[x['state']] - 1),
+                                            axis=1)
+
+    # save raw output file
+    output_df.to_csv('data/output/voter_power/all_results_raw' +
+                     datestring + '.csv', index=False)
+
+    # delete unecessary columns
+    output_df = output_df[['state', 'district', 'incumbent', 'favored',
+                           'confidence', 'nom_R', 'nom_D', 'nom_I', 'cvap',
+                           'VOTER_POWER', 'redistricting_voter_power']]
+
+    output_df.to_csv('data/output/voter_power/all_results' +
+                     datestring + '.csv', index=False)
+
+
+if __name__ == "__main__":
+    main()
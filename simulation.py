@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo simulation of every state's chamber outcomes at once. Unlike the
+quadrature in voter_power, which integrates each state independently, draws
+here can share a national swing across states, so cross-state questions
+(e.g. the probability that at least N states end up with bipartisan
+redistricting) can be answered. Draws are made and evaluated in chunks and
+only running totals are kept, so memory does not grow with the number of
+draws.
+
+The correlated shifts are not drawn from their t-distributions, but from the
+distributions that the pdf weighted quadrature of voter_power converges to
+as nodes are added (see quadrature.pdf_weighted_density), so that draws
+estimate the same probabilities and voter powers the model reports. Those
+distributions have lighter tails than the t-distributions, and sampling the
+t-distributions instead would give noticeably different results (about 0.01
+to 0.06 in the probability of bipartisan control of a state). The model's
+rule has finitely many nodes, so its results still differ from what draws
+converge to by its own discretization error (up to about 0.01 with the
+shipped nodes).
+
+For voter powers in states whose outcome is nearly certain, estimate_powers
+samples only the correlated errors (integrating race errors exactly at each
+draw, as the quadrature does) and cuts the variance further with antithetic
+draws, a control variate whose mean is found with the model's quadrature
+rule, and importance sampling that tilts the statewide shift toward where the
+state is decided.
+"""
+import scipy.stats as sts
+import numpy as np
+from quadrature import percentile_nodes, pdf_weighted_density, \
+    pdf_weighted_draws
+from voter_power import chamber_node_states, success_from_dem_probs, \
+    probs_from_margins, tail_prob_sensitivity, full_distribution_method
+
+
+def draw_shifts(rng, t_dist_params, num_draws):
+    """ Draws shifts as the model's quadrature weighs them (see
+    quadrature.pdf_weighted_draws), one row per draw and one column per
+    ((sigma, deg_f), ...) in t_dist_params.
+    """
+
+    shifts = np.empty((num_draws, len(t_dist_params)))
+    for i, ((sigma, deg_f), *_) in enumerate(t_dist_params):
+        shifts[:, i] = pdf_weighted_draws(rng, sigma, deg_f, num_draws)
+    return shifts
+
+
+def simulate_dem_power(rng, seats, threshold, tie):
+    """ Draws whether D's have redistricting power in a chamber given the
+    seats they won in each draw (hitting the threshold on the mark gives
+    power with probability tie).
+    """
+
+    if threshold == 'D':
+        return np.ones(len(seats), dtype=bool)
+    if threshold == 'R':
+        return np.zeros(len(seats), dtype=bool)
+    return (seats > threshold) | ((seats == threshold) &
+                                  (rng.random(len(seats)) < tie))
+
+
+def simulate_success(rng, model, shifts, race_sigma, race_deg_f):
+    """ Simulates whether a state ends up with bipartisan redistricting in
+    each draw, given the correlated shifts (one row per draw).
+    """
+
+    # expected margins, then the outcome of every race with its own error
+    weights = model['parameter_weights']
+    margins = weights[:, 0] + shifts.dot(weights[:, 1:].T)
+    wins = margins + race_sigma * rng.standard_t(race_deg_f,
+                                                 margins.shape) > 0
+
+    # D power in each chamber
+    ix = model['chamber_2_ix']
+    dem_power = [simulate_dem_power(rng, seats, threshold, tie) for
+                 seats, threshold, tie in
+                 zip([wins[:, :ix].sum(axis=1), wins[:, ix:].sum(axis=1)],
+                     model['thresholds'], model['ties'])]
+
+    # a bad outcome is D power in both (if both_bad) or neither (if
+    # neither_bad) chamber
+    bad = (model['both_bad'] & dem_power[0] & dem_power[1]) | \
+        (model['neither_bad'] & ~dem_power[0] & ~dem_power[1])
+    return ~bad
+
+
+class SimulationResult():
+    """ Running totals of a simulation, and the statistics found from them.
+
+    Attributes:
+        states: list of states simulated
+        num_draws: number of draws so far
+        successes: numpy array of the number of draws with bipartisan
+            redistricting in each state
+        joint_successes: numpy array, element (i, j) is the number of draws
+            with bipartisan redistricting in both state i and state j
+        count_draws: numpy array, element n is the number of draws with
+            bipartisan redistricting in exactly n states
+    """
+
+    def __init__(self, states):
+        self.states = list(states)
+        self.num_draws = 0
+        self.successes = np.zeros(len(states), dtype=np.int64)
+        self.joint_successes = np.zeros((len(states), len(states)),
+                                        dtype=np.int64)
+        self.count_draws = np.zeros(len(states) + 1, dtype=np.int64)
+
+    def add(self, success):
+        """ Adds a chunk of draws, a boolean numpy array with one row per
+        draw and one column per state.
+        """
+
+        self.num_draws += len(success)
+        self.successes += success.sum(axis=0)
+        as_int = success.astype(np.int64)
+        self.joint_successes += as_int.T.dot(as_int)
+        self.count_draws += np.bincount(success.sum(axis=1),
+                                        minlength=len(self.states) + 1)
+
+    @property
+    def probs(self):
+        """ Probability of bipartisan redistricting in each state. """
+
+        return self.successes / self.num_draws
+
+    @property
+    def std_errs(self):
+        """ Standard error of each state's probability. """
+
+        probs = self.probs
+        return np.sqrt(probs * (1 - probs) / self.num_draws)
+
+    @property
+    def joint_probs(self):
+        """ Probability of bipartisan redistricting in each pair of states.
+        """
+
+        return self.joint_successes / self.num_draws
+
+    @property
+    def count_probs(self):
+        """ Probability of bipartisan redistricting in exactly n states, for
+        n from 0 to the number of states.
+        """
+
+        return self.count_draws / self.num_draws
+
+    def prob_at_least(self, num_states):
+        """ Probability of bipartisan redistricting in at least num_states
+        states.
+        """
+
+        return self.count_draws[num_states:].sum() / self.num_draws
+
+
+def simulate_states(models, error_vars, race_sigma, race_deg_f, num_draws,
+                    national_vars=None, seed=None, chunk_size=100000):
+    ''' Simulates the chamber outcomes of many states at once. In each draw,
+    every state gets its own correlated shifts from error_vars, plus a
+    national shift shared by every state from national_vars (both drawn as
+    the model's quadrature weighs them, see draw_shifts), and every race its
+    own t-distributed error. Without national shifts, each state's
+    probability estimates what voter_power's quadrature converges to.
+
+    Arguments:
+        models: dictionary of voter_power.state_model output keyed by state
+        error_vars: as in voter_power.state_voter_powers, the state level
+            sources of correlated error
+        race_sigma, race_deg_f: as in voter_power.state_voter_powers
+        num_draws: number of draws
+        national_vars (optional): dictionary keyed by (some of) the keys of
+            error_vars, with values (sigma, deg_f) of a national shift in that
+            source of error shared by all states (adding to each state's own
+            shift, so it widens each state's distribution)
+        seed (optional): seed of the random number generator (results depend
+            on the seed and chunk_size)
+        chunk_size (optional): number of draws made and evaluated at once
+    Output: SimulationResult
+    '''
+
+    t_dist_params = list(error_vars.values())
+    national_vars = national_vars or {}
+    national_cols = [list(error_vars).index(var) for var in national_vars]
+    national_params = [(params,) for params in national_vars.values()]
+
+    states = list(models)
+    result = SimulationResult(states)
+    chunk_seeds = np.random.SeedSequence(seed).spawn(
+        -(-num_draws // chunk_size))
+    for chunk_seed, start in zip(chunk_seeds,
+                                 range(0, num_draws, chunk_size)):
+        rng = np.random.default_rng(chunk_seed)
+        size = min(chunk_size, num_draws - start)
+
+        # national shifts, shared by every state in a draw
+        national = draw_shifts(rng, national_params, size)
+
+        success = np.empty((size, len(states)), dtype=bool)
+        for i, state in enumerate(states):
+            shifts = draw_shifts(rng, t_dist_params, size)
+            shifts[:, national_cols] += national
+            success[:, i] = simulate_success(rng, models[state], shifts,
+                                             race_sigma, race_deg_f)
+        result.add(success)
+
+    return result
+
+
+def node_values(model, shifts, races, margin_changes, race_sigma, race_deg_f,
+                tcdf, seat_method='auto'):
+    """ Probability of success at each of a batch of shifts (race errors
+    integrated exactly), and its change from changing the margin of each of
+    races by margin_changes, one at a time.
+
+    Arguments:
+        model: voter_power.state_model output
+        shifts: numpy array, one row per draw and one column per source of
+            correlated error
+        races, margin_changes: numpy arrays of race indices (rows of
+            model['parameter_weights']) and the change in each one's margin
+        race_sigma, race_deg_f, tcdf, seat_method: as in
+            voter_power.success_prob_increases (which needs the full seat
+            distributions, see voter_power.full_distribution_method)
+    Output: numpy array with one row per draw, the probability of success in
+        column 0 and the change for each race in the rest
+    """
+
+    weights = model['parameter_weights']
+    margins = weights[:, 0] + shifts.dot(weights[:, 1:].T)
+    states = chamber_node_states(margins, *model['thresholds'],
+                                 *model['ties'], model['chamber_2_ix'],
+                                 race_sigma, race_deg_f, tcdf,
+                                 full_distribution_method(seat_method))
+
+    values = np.zeros((len(shifts), len(races) + 1))
+    values[:, 0] = success_from_dem_probs(states[0]['dem_prob'],
+                                          states[1]['dem_prob'],
+                                          model['both_bad'],
+                                          model['neither_bad'])
+    bounds = [(0, model['chamber_2_ix']), (model['chamber_2_ix'],
+                                           len(weights))]
+    for c, (state, (start, stop)) in enumerate(zip(states, bounds)):
+        ix = np.flatnonzero((races >= start) & (races < stop))
+        if state['probs'] is None or len(ix) == 0:
+            continue
+
+        # the probability of success is linear in the probability of D power
+        # in this chamber, which is linear in each race's win probability
+        other_prob = states[1 - c]['dem_prob']
+        success_slope = model['neither_bad'] * (1 - other_prob) - \
+            model['both_bad'] * other_prob
+        probs = state['probs'][:, races[ix] - start]
+        new_probs = probs_from_margins(margins[:, races[ix]] +
+                                       margin_changes[ix], race_sigma,
+                                       race_deg_f, tcdf)
+        sensitivity = tail_prob_sensitivity(state['seat_probs'], probs,
+                                            state['threshold'], state['tie'])
+        values[:, ix + 1] = (new_probs - probs) * sensitivity * \
+            success_slope[:, np.newaxis]
+
+    return values
+
+
+def interpolate(points, values, x):
+    """ Piecewise linear interpolation of each column of values (one row per
+    point, points ascending) at x, constant beyond either end.
+    """
+
+    x = np.clip(x, points[0], points[-1])
+    ix = np.clip(np.searchsorted(points, x) - 1, 0, len(points) - 2)
+    frac = (x - points[ix]) / (points[ix + 1] - points[ix])
+    return values[ix] + frac[:, np.newaxis] * (values[ix + 1] - values[ix])
+
+
+def interpolant_mean(points, values, sigma, deg_f, num_nodes=20001):
+    """ Expectation of the interpolant of each column of values (see
+    interpolate) as the model's quadrature weighs the shift: the pdf
+    weighted rule of quadrature.percentile_nodes, used by
+    voter_power.chamber_success_prob, with num_nodes nodes (enough that the
+    rule has converged to well below the noise of any simulation).
+    """
+
+    nodes, weights = percentile_nodes(sigma, deg_f, num_nodes)
+    return (weights / np.sum(weights)).dot(interpolate(points, values, nodes))
+
+
+class PowerEstimate():
+    """ Monte Carlo estimate of the probability of success and voter powers
+    of a state (see estimate_powers).
+
+    Attributes:
+        prob, prob_std_err: probability of success and its standard error
+        powers, power_std_errs: numpy arrays of the increase in probability of
+            success from one vote in each race, and their standard errors
+        ess: numpy array of the effective sample size of the probability
+            (first) and each power, the number of plain Monte Carlo draws of
+            the correlated errors that would give the same standard error
+        weight_ess: effective sample size of the importance weights alone,
+            (sum of weights)^2 / sum of squared weights
+        num_draws: number of draws made
+    """
+
+    def __init__(self, estimates, std_errs, ess, weight_ess, num_draws):
+        self.prob = estimates[0]
+        self.prob_std_err = std_errs[0]
+        self.powers = estimates[1:]
+        self.power_std_errs = std_errs[1:]
+        self.ess = ess
+        self.weight_ess = weight_ess
+        self.num_draws = num_draws
+
+
+def estimate_powers(model, error_vars, race_sigma, race_deg_f, tcdf, races,
+                    num_voters, target_rel_err=0.01, antithetic=True,
+                    control_variate=True, tilt=True, tilt_share=0.5,
+                    statewide_var='statewide', cv_nodes=65, min_draws=2000,
+                    max_draws=1000000, chunk_size=1000, seed=None,
+                    seat_method='auto'):
+    ''' Estimates the probability of success and voter powers of a state by
+    sampling the correlated errors, drawing until every nonzero estimate is
+    within target_rel_err (one standard error). Race errors are integrated
+    exactly at every draw, so only the correlated errors add noise, which is
+    reduced by
+
+    - antithetic draws: every draw is paired with its reflection (all shifts
+      negated, about the center of the importance sampling component it came
+      from),
+    - a control variate: each quantity at the statewide shift of the draw
+      with the other shifts at 0, interpolated from cv_nodes points, whose
+      expectation is found with the model's quadrature rule (see
+      interpolant_mean); its coefficient is fit by regression on the draws,
+    - importance sampling: the statewide shift is drawn from a defensive
+      mixture, with tilt_share of draws from its t-distribution centered
+      where the state is most likely decided (the peak of the density times
+      the slope of the probability of success along the statewide shift),
+      the rest as the model weighs it, so importance weights never exceed
+      1 / (1 - tilt_share).
+
+    Shifts are weighed as the model's quadrature weighs them (see
+    draw_shifts), so the estimates converge to what voter_power's
+    probability and voter powers converge to as its nodes are added.
+
+    Arguments:
+        model: voter_power.state_model output
+        error_vars: as in voter_power.state_voter_powers
+        race_sigma, race_deg_f, tcdf: as in voter_power.state_voter_powers
+        races: list of row indices of model['parameter_weights'] to find the
+            voter power of
+        num_voters: list of the number of voters in each of these races
+        target_rel_err (optional): relative standard error to reach
+        antithetic, control_variate, tilt (optional): whether to use each
+            variance reduction
+        tilt_share (optional): share of draws from the tilted component
+        statewide_var (optional): key of error_vars of the shift to tilt and
+            to build the control variate on
+        cv_nodes (optional): number of points of the control variate
+        min_draws, max_draws (optional): bounds on the number of draws
+        chunk_size (optional): number of draws evaluated at once (even if
+            antithetic)
+        seed (optional): seed of the random number generator
+        seat_method (optional): as in node_values
+    Output: PowerEstimate
+    '''
+
+    races = np.asarray(races, dtype=int)
+    margin_changes = 1 / np.asarray(num_voters, dtype=float)
+    t_dist_params = [params for params, _ in error_vars.values()]
+    col = list(error_vars).index(statewide_var)
+    sigma, deg_f = t_dist_params[col]
+
+    # each quantity along the statewide shift, with the other shifts at 0
+    points = np.sort(percentile_nodes(sigma, deg_f, cv_nodes)[0])
+    line_shifts = np.zeros((cv_nodes, len(t_dist_params)))
+    line_shifts[:, col] = points
+    line_values = node_values(model, line_shifts, races, margin_changes,
+                              race_sigma, race_deg_f, tcdf, seat_method)
+    cv_means = interpolant_mean(points, line_values, sigma, deg_f)
+
+    # center the tilted component where the state is most likely decided
+    center = 0
+    if tilt:
+        slope = np.abs(np.gradient(line_values[:, 0], points))
+        center = points[np.argmax(slope * pdf_weighted_density(points, sigma,
+                                                               deg_f))]
+    share = tilt_share if tilt else 0
+
+    # running sums over (pairs of) draws of the importance weighted values
+    # y, their control variates h and the weighted squares of the values
+    num_qty = len(races) + 1
+    sums = {key: np.zeros(num_qty) for key in ['y', 'h', 'yy', 'hh', 'yh',
+                                                'wff']}
+    weight_sums = np.zeros(2)
+    num_draws = num_units = 0
+    per_unit = 2 if antithetic else 1
+    seeds = np.random.SeedSequence(seed)
+    while num_draws < max_draws:
+        rng = np.random.default_rng(seeds.spawn(1)[0])
+        size = min(chunk_size, max_draws - num_draws) // per_unit
+        size = max(size, 1)
+
+        # draw standard shifts, and the component of each statewide shift
+        # (standard t variates in the tilted component)
+        z = draw_shifts(rng, [((1, d),) for _, d in t_dist_params], size)
+        tilted = rng.random(size) < share
+        z[tilted, col] = rng.standard_t(deg_f, np.sum(tilted))
+        centers = np.where(tilted, center, 0)
+        signs = [1, -1] if antithetic else [1]
+
+        y = h = 0
+        for sign in signs:
+            shifts = sign * z * [s for s, _ in t_dist_params]
+            shifts[:, col] += centers
+            x = shifts[:, col]
+
+            # importance weights of the statewide shift
+            density = pdf_weighted_density(x, sigma, deg_f)
+            weights = density / ((1 - share) * density + share *
+                                 sts.t.pdf((x - center) / sigma, deg_f) /
+                                 sigma)
+            values = node_values(model, shifts, races, margin_changes,
+                                 race_sigma, race_deg_f, tcdf, seat_method)
+            controls = interpolate(points, line_values, x)
+            y = y + weights[:, np.newaxis] * values / len(signs)
+            h = h + weights[:, np.newaxis] * controls / len(signs)
+            sums['wff'] += weights.dot(values**2)
+            weight_sums += [np.sum(weights), np.sum(weights**2)]
+
+        for key, array in [('y', y), ('h', h), ('yy', y * y),
+                           ('hh', h * h), ('yh', y * h)]:
+            sums[key] += np.sum(array, axis=0)
+        num_units += size
+        num_draws += size * len(signs)
+
+        # estimates with the control variate fit by regression
+        mean = {key: value / num_units for key, value in sums.items()}
+        var_y = mean['yy'] - mean['y']**2
+        var_h = mean['hh'] - mean['h']**2
+        cov = mean['yh'] - mean['y'] * mean['h']
+        beta = np.zeros(num_qty)
+        if control_variate:
+            fit = var_h > 1e-15 * np.maximum(var_y, 1e-300)
+            beta[fit] = cov[fit] / var_h[fit]
+        estimates = mean['y'] - beta * (mean['h'] - cv_means)
+        resid_var = np.maximum(var_y - 2 * beta * cov + beta**2 * var_h, 0)
+        std_errs = np.sqrt(resid_var / max(num_units - 1, 1))
+
+        # stop once every nonzero estimate is precise enough
+        done = std_errs <= target_rel_err * np.abs(estimates)
+        if num_draws >= min_draws and np.all(done | (std_errs == 0)):
+            break
+
+    # plain Monte Carlo variance of each quantity, for effective sample sizes
+    plain_var = np.maximum(sums['wff'] / num_draws - estimates**2, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ess = np.where(std_errs > 0, plain_var / std_errs**2, np.inf)
+    weight_ess = weight_sums[0]**2 / weight_sums[1]
+    return PowerEstimate(estimates, std_errs, ess, weight_ess, num_draws)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Batch engine that finds the probability of bipartisan control in many states
+at once. Every state's chambers are packed into padded arrays (state x race,
+padding races never won) with their thresholds, ties and both_bad /
+neither_bad flags, so that margins, win probabilities and seat distributions
+at every quadrature node are found for all states in a handful of array
+operations rather than one Python call stack per state. All states share one
+quadrature rule, so they must share error_vars.
+"""
+import numpy as np
+import pandas as pd
+from quadrature import quadrature_rule
+from voter_power import MAX_CHUNK_ELEMENTS, probs_from_margins, \
+    seat_distribution, state_model
+
+
+class StateBatch():
+    """ Chambers of many states, padded to the same number of races.
+
+    Attributes:
+        states: list of states, in the order of the first axis of every array
+        weights: list with, for each chamber, a numpy array (state x race x
+            (1 + number of error_vars)) of the parameter weights of its races
+            (see voter_power.chamber_success_prob), 0 for padding
+        masks: list with, for each chamber, a boolean numpy array (state x
+            race), True for real races
+        coefs: list with, for each chamber, a numpy array (state x seats won)
+            giving the probability of D power with that many seats (0 below
+            the threshold, the tie probability at it and 1 above)
+        fixed: numpy array (state x chamber) of the probability of D power in
+            chambers not in question (1 if 'D', 0 if 'R'), -1 for the rest
+        both_bad, neither_bad: numpy arrays of each state's flags
+    """
+
+    def __init__(self, models):
+        ''' Packs the chambers of many states.
+
+        Arguments:
+            models: dictionary of voter_power.state_model output keyed by
+                state
+        '''
+
+        self.states = list(models)
+        num_states = len(self.states)
+        num_params = len(next(iter(models.values()))['parameter_weights'][0])
+        bounds = {state: [(0, model['chamber_2_ix']),
+                          (model['chamber_2_ix'],
+                           len(model['parameter_weights']))]
+                  for state, model in models.items()}
+        sizes = [max(bounds[state][c][1] - bounds[state][c][0] for state in
+                     self.states) for c in range(2)]
+
+        self.weights = [np.zeros((num_states, size, num_params)) for size in
+                        sizes]
+        self.masks = [np.zeros((num_states, size), dtype=bool) for size in
+                      sizes]
+        self.coefs = [np.zeros((num_states, size + 1)) for size in sizes]
+        self.fixed = -np.ones((num_states, 2))
+        self.both_bad = np.zeros(num_states)
+        self.neither_bad = np.zeros(num_states)
+        for s, state in enumerate(self.states):
+            model = models[state]
+            self.both_bad[s] = model['both_bad']
+            self.neither_bad[s] = model['neither_bad']
+            for c, (start, stop) in enumerate(bounds[state]):
+                threshold = model['thresholds'][c]
+                if threshold in ['D', 'R']:
+                    self.fixed[s, c] = float(threshold == 'D')
+                    continue
+                self.weights[c][s, :stop - start] = \
+                    model['parameter_weights'][start:stop]
+                self.masks[c][s, :stop - start] = True
+                self.coefs[c][s, threshold] = model['ties'][c]
+                self.coefs[c][s, threshold + 1:] = 1
+
+
+def state_batch(all_races, margin_col, threshold_col, tie_col, chamber_col,
+                states, error_vars, rating_to_margin_df, options=None):
+    ''' Prepares the races of many states and packs them into a StateBatch.
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, chamber_col,
+            error_vars, rating_to_margin_df: as in
+            voter_power.state_voter_powers
+        states: list of states to pack
+        options (optional): dictionary keyed by state of the blending keyword
+            arguments (found_margin_col, found_clip, blend_safe, blend_else)
+            of each state, none by default
+    Output: StateBatch
+    '''
+
+    options = options or {}
+    models = {state: state_model(all_races, margin_col, threshold_col,
+                                 tie_col, chamber_col, state, error_vars,
+                                 rating_to_margin_df,
+                                 **options.get(state, {}))
+              for state in states}
+    return StateBatch(models)
+
+
+def batch_success_probs(batch, error_vars, race_sigma, race_deg_f, tcdf,
+                        seat_method='auto', chunk_size=None, rule=None):
+    ''' Finds the probability of bipartisan control of every state in a
+    batch. At each chunk of nodes, the margins of every race of every state
+    come from one batched matrix product, and the seat distributions of each
+    chamber of every state are found in one call (padding races have win
+    probability 0, so they never add a seat).
+
+    Arguments:
+        batch: StateBatch
+        error_vars, race_sigma, race_deg_f, tcdf: as in
+            voter_power.state_voter_powers
+        seat_method (optional): method used by voter_power.seat_distribution
+        chunk_size (optional): number of nodes to evaluate at once, defaults
+            to as many as fit in MAX_CHUNK_ELEMENTS elements per array
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of error_vars
+    Output: numpy array of the probability of bipartisan control of each state
+        in batch.states
+    '''
+
+    if rule is None:
+        rule = quadrature_rule(list(error_vars.values()))
+    num_nodes = len(rule)
+    num_states = len(batch.states)
+
+    # bound memory use by the (states x nodes x races) arrays
+    if chunk_size is None:
+        num_races = max(mask.shape[1] for mask in batch.masks) + 1
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (num_states * num_races))
+
+    prob = np.zeros(num_states)
+    for start in range(0, num_nodes, chunk_size):
+        stop = min(start + chunk_size, num_nodes)
+        design_t = rule.design[start:stop].T
+
+        dem_probs = []
+        for c in range(2):
+            dem_prob = np.empty((num_states, stop - start))
+            dem_prob[:] = batch.fixed[:, c:c + 1]
+            in_question = batch.fixed[:, c] < 0
+            if np.any(in_question):
+
+                # margins (state x node x race), then win probabilities with
+                # the padding zeroed out
+                margins = np.matmul(batch.weights[c][in_question],
+                                    design_t).transpose(0, 2, 1)
+                probs = probs_from_margins(margins, race_sigma, race_deg_f,
+                                           tcdf)
+                probs *= batch.masks[c][in_question][:, np.newaxis, :]
+
+                # probability of D power from the distribution of seats won
+                seat_probs = seat_distribution(probs, seat_method)
+                dem_prob[in_question] = np.matmul(
+                    seat_probs, batch.coefs[c][in_question][:, :, np.newaxis]
+                    )[:, :, 0]
+            dem_probs.append(dem_prob)
+
+        # success, with each state's flags
+        both_bad = batch.both_bad[:, np.newaxis]
+        neither_bad = batch.neither_bad[:, np.newaxis]
+        success = 1 - both_bad * dem_probs[0] * dem_probs[1] - \
+            neither_bad * (1 - dem_probs[0]) * (1 - dem_probs[1])
+        prob += success.dot(rule.weights[start:stop])
+
+    return prob / np.sum(rule.weights)
+
+
+def state_batch_probs(all_races, margin_col, threshold_col, tie_col,
+                      chamber_col, states, error_vars, race_sigma, race_deg_f,
+                      rating_to_margin_df, tcdf, options=None,
+                      seat_method='auto', chunk_size=None, rule=None):
+    ''' Finds the probability of bipartisan control of every state in one
+    batch.
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, chamber_col,
+            error_vars, race_sigma, race_deg_f, rating_to_margin_df, tcdf:
+            as in voter_power.state_voter_powers
+        states: list of states
+        options (optional): as in state_batch
+        seat_method, chunk_size, rule (optional): as in batch_success_probs
+    Output: pandas DataFrame with columns 'state' and 'bipartisan_prob'
+    '''
+
+    batch = state_batch(all_races, margin_col, threshold_col, tie_col,
+                        chamber_col, states, error_vars, rating_to_margin_df,
+                        options)
+    probs = batch_success_probs(batch, error_vars, race_sigma, race_deg_f,
+                                tcdf, seat_method, chunk_size, rule)
+    return pd.DataFrame({'state': batch.states, 'bipartisan_prob': probs})
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Sensitivity sweeps over the uncertainty settings of the model: race_sigma,
+race_deg_f and the time decay deg_f_scale (see voter_power.time_decay_scale).
+Everything that does not depend on these (each state's prepared races and
+margins) is found once, quadrature rules are cached per deg_f_scale and t cdf
+tables per degrees of freedom (compact by default, calculated once before the
+workers start and cached on disk, see tcdf_cache.py), and the (setting, state)
+jobs run in a pool of worker processes. The output is a tidy table of
+each state's probability of bipartisan control and the stability of its
+voter power ranking under each setting, relative to a baseline setting.
+"""
+import os
+import itertools as it
+import numpy as np
+import pandas as pd
+import scipy.stats as sts
+from multiprocessing import Pool
+from quadrature import quadrature_rule
+from tcdf_cache import load_tcdf, load_compact_tcdf
+from voter_power import prepare_state_races, voter_power, \
+    correlated_error_vars
+
+# arguments shared by every job, set once in each worker process
+_shared = {}
+
+# t cdf tables opened in this process, keyed by degrees of freedom
+_tcdfs = {}
+
+
+def sweep_settings(race_sigmas, race_deg_fs, deg_f_scales):
+    """ Every combination of the settings, as a list of dictionaries with
+    keys 'race_sigma', 'race_deg_f' (before the time decay, the model uses 5)
+    and 'deg_f_scale' (see voter_power.time_decay_scale).
+    """
+
+    return [{'race_sigma': sigma, 'race_deg_f': deg_f, 'deg_f_scale': scale}
+            for sigma, deg_f, scale in it.product(race_sigmas, race_deg_fs,
+                                                   deg_f_scales)]
+
+
+def prepare_states(all_races, margin_col, threshold_col, tie_col, states,
+                   rating_to_margin_df, options=None):
+    ''' Prepares the races of every state once for a whole sweep.
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, rating_to_margin_df:
+            as in voter_power.state_voter_powers
+        states: list of states
+        options (optional): dictionary keyed by state of its blending keyword
+            arguments (see voter_power.state_options)
+    Output: dictionary of the prepared races (see
+        voter_power.prepare_state_races) of each state
+    '''
+
+    options = options or {}
+    return {state: prepare_state_races(all_races, margin_col, threshold_col,
+                                       tie_col, state, rating_to_margin_df,
+                                       **options.get(state, {}))
+            for state in states}
+
+
+def init_worker(shared):
+    """ Stores the arguments shared by every job in a worker process. """
+
+    _shared.update(shared)
+
+
+def tcdf_loader(compact):
+    """ Function loading the t cdf table of given degrees of freedom, compact
+    or full (see tcdf_cache.py).
+    """
+
+    return load_compact_tcdf if compact else load_tcdf
+
+
+def run_job(job):
+    """ Runs voter_power for one state under one setting in a worker. """
+
+    setting_ix, state = job
+    setting = _shared['settings'][setting_ix]
+    deg_f_scale = setting['deg_f_scale']
+    race_deg_f = setting['race_deg_f'] / deg_f_scale
+
+    # reuse the tables and rules of earlier jobs (tables are already cached
+    # on disk by sweep, so this only memory-maps them)
+    if race_deg_f not in _tcdfs:
+        _tcdfs[race_deg_f] = tcdf_loader(_shared['compact'])(race_deg_f)
+    error_vars = correlated_error_vars(_shared['err_df'], deg_f_scale)
+    rule = quadrature_rule(list(error_vars.values()))
+
+    st_races = _shared['prepared'][state].copy()
+    cols = _shared['cols']
+    result = voter_power(st_races, error_vars, setting['race_sigma'],
+                         race_deg_f, st_races['both_bad'].unique()[0],
+                         st_races['neither_bad'].unique()[0],
+                         cols['margin_col'], cols['voters_col'],
+                         cols['threshold_col'], cols['tie_col'],
+                         cols['chamber_col'], cols['power_col'],
+                         _shared['prob_only'], _tcdfs[race_deg_f], rule=rule)
+    powers = None
+    if not _shared['prob_only']:
+        powers = result.districts[cols['power_col']].to_numpy()
+    return result.bipartisan_prob, powers
+
+
+def rank_stability(powers, base_powers, top_k):
+    """ Spearman correlation of two sets of voter powers of a state's races,
+    and the share of the top_k races by base_powers that are also in the
+    top_k by powers.
+    """
+
+    if len(powers) < 2 or np.all(powers == powers[0]) or \
+            np.all(base_powers == base_powers[0]):
+        corr = np.nan
+    else:
+        corr = sts.spearmanr(powers, base_powers)[0]
+    k = min(top_k, len(powers))
+    top = set(np.argsort(-powers, kind='stable')[:k])
+    base_top = set(np.argsort(-base_powers, kind='stable')[:k])
+    return corr, len(top & base_top) / max(k, 1)
+
+
+def sweep(prepared, err_df, settings, margin_col, voters_col, threshold_col,
+          tie_col, chamber_col, power_col, baseline=0, top_k=10,
+          prob_only=False, processes=None, compact=True):
+    ''' Runs every state under every setting.
+
+    Arguments:
+        prepared: prepare_states output
+        err_df: DataFrame of correlated_error_parameters.csv
+        settings: list of settings (see sweep_settings)
+        margin_col, voters_col, threshold_col, tie_col, chamber_col,
+            power_col: as in voter_power.state_voter_powers
+        baseline (optional): index into settings of the setting the others
+            are compared to
+        top_k (optional): number of top races compared by rank stability
+        prob_only (optional): if True, skip voter powers (and rank stability)
+        processes (optional): number of worker processes (None for one per
+            core, 1 to run in this process)
+        compact (optional): if True, use the compact t cdf tables (under 1 MB
+            each, within about 1e-7, see tcdf_cache.load_compact_tcdf)
+            rather than the full 80 MB ones
+    Output: DataFrame with one row per setting and state, with columns
+        'race_sigma', 'race_deg_f', 'deg_f_scale', 'state',
+        'bipartisan_prob', 'prob_change' (from the baseline setting) and,
+        unless prob_only, 'rank_corr' (Spearman correlation of the state's
+        voter powers with the baseline's) and 'top_k_overlap' (share of the
+        baseline's top_k races still in the top_k)
+    '''
+
+    shared = {'prepared': prepared, 'err_df': err_df, 'settings': settings,
+              'prob_only': prob_only, 'compact': compact,
+              'cols': {'margin_col': margin_col, 'voters_col': voters_col,
+                       'threshold_col': threshold_col, 'tie_col': tie_col,
+                       'chamber_col': chamber_col, 'power_col': power_col}}
+
+    # calculate every table needed once here, so that workers never
+    # calculate the same table at the same time
+    for deg_f in set(setting['race_deg_f'] / setting['deg_f_scale'] for
+                     setting in settings):
+        tcdf_loader(compact)(deg_f)
+
+    # jobs for the largest states first, settings sharing tables together
+    states = list(prepared)
+    order = sorted(states, key=lambda x: -len(prepared[x]))
+    jobs = [(setting_ix, state) for state in order for setting_ix in
+            range(len(settings))]
+    if processes == 1:
+        init_worker(shared)
+        results = list(map(run_job, jobs))
+    else:
+        processes = processes or os.cpu_count()
+        with Pool(min(processes, len(jobs)), init_worker, (shared,)) as pool:
+            results = pool.map(run_job, jobs)
+    results = dict(zip(jobs, results))
+
+    # one row per setting and state
+    rows = []
+    for setting_ix, setting in enumerate(settings):
+        for state in states:
+            prob, powers = results[(setting_ix, state)]
+            base_prob, base_powers = results[(baseline, state)]
+            row = dict(setting, state=state, bipartisan_prob=prob,
+                       prob_change=prob - base_prob)
+            if not prob_only:
+                row['rank_corr'], row['top_k_overlap'] = rank_stability(
+                    powers, base_powers, top_k)
+            rows.append(row)
+
+    return pd.DataFrame(rows)
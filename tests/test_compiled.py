@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the compiled kernels agree with NumPy (see
+compiled.check_backends), and that an explicit seat method is honored with
+the 'numba' backend.
+"""
+import os
+import sys
+import types
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import compiled  # noqa: E402
+import voter_power as vp  # noqa: E402
+from tcdf_cache import calculate_tcdf  # noqa: E402
+
+
+def test_python_backend():
+    diffs = compiled.check_backends('python')
+    assert max(diffs.values()) <= 1e-12
+
+
+def test_python_backend_is_uncompiled():
+    # every kernel the 'python' backend reaches is a plain Python function
+    for name, func in compiled._PYTHON_KERNELS.items():
+        assert type(func) is types.FunctionType, name
+        for other in compiled._PYTHON_KERNELS:
+            assert func.__globals__[other] is \
+                compiled._PYTHON_KERNELS[other], (name, other)
+        assert func.__globals__['_node_range'] is range
+
+
+@pytest.mark.skipif(not compiled.NUMBA_AVAILABLE,
+                    reason='numba is not installed')
+def test_numba_backend():
+    diffs = compiled.check_backends('numba')
+    assert max(diffs.values()) <= 1e-12
+
+
+@pytest.mark.skipif(not compiled.NUMBA_AVAILABLE,
+                    reason='numba is not installed')
+def test_numba_honors_seat_method():
+    assert vp.use_compiled('auto', 'numba')
+    assert vp.use_compiled('windowed', 'numba')
+    assert not vp.use_compiled('fft', 'numba')
+    assert not vp.use_compiled(vp.NormalApproximation(), 'numba')
+
+    # an explicit seat_distribution method gives its own result
+    rng = np.random.default_rng(0)
+    margins = rng.normal(0, 0.1, (20, 30))
+    tcdf = calculate_tcdf(5, 100001)
+    fft = vp.dem_chamber_power(margins, 15, 0.5, 0.07, 5, tcdf, 'fft',
+                               'numba')
+    direct = vp.dem_chamber_power(margins, 15, 0.5, 0.07, 5, tcdf,
+                                  'direct', 'numpy')
+    assert np.max(np.abs(fft - direct)) <= 1e-12
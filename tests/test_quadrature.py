@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the sparse grids of quadrature.py converge on the shipped error
+parameters, to the value the tensor rule of chamber_success_prob converges to.
+"""
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import voter_power as vp  # noqa: E402
+from quadrature import level_nodes, nested_nodes, percentile_nodes, \
+    pdf_weighted_draws  # noqa: E402
+from tcdf_cache import calculate_tcdf  # noqa: E402
+
+ERR_PATH = os.path.join(ROOT, 'data', 'input', 'parameters',
+                        'correlated_error_parameters.csv')
+RACE_SIGMA = 0.07
+RACE_DEG_F = 5
+
+
+def shipped_t_dist_params(statewide_nodes=None, other_nodes=None):
+    # ((sigma, deg_f), nodes) of every source of correlated error, with the
+    # shipped numbers of nodes unless others are passed
+    err_df = pd.read_csv(ERR_PATH)
+    t_dist_params = []
+    for _, row in err_df.iterrows():
+        nodes = statewide_nodes if row['parameter'] == 'statewide' else \
+            other_nodes
+        t_dist_params.append(((row['sigma'], row['deg_f']),
+                              nodes or row['nodes']))
+    return t_dist_params
+
+
+def random_state(seed=0, num_races=(40, 60)):
+    # margins and density proportions of a close state, as in state_model
+    rng = np.random.default_rng(seed)
+    total = sum(num_races)
+    parameter_weights = np.column_stack((
+        rng.normal(0, 0.1, total), np.ones(total),
+        rng.dirichlet(np.ones(4), total)))
+    return (parameter_weights, num_races[0] // 2, num_races[1] // 2, 0.5,
+            0.5, num_races[0], RACE_SIGMA, RACE_DEG_F, 0, 1)
+
+
+@pytest.fixture(scope='module')
+def tcdf():
+    return calculate_tcdf(RACE_DEG_F, 100001)
+
+
+def test_nested_nodes():
+    # every level keeps the nodes of the one below, and pdf weights sum to 1
+    # like Fejer's
+    for level in range(1, 5):
+        points, weights = nested_nodes(0.05, 5, level)
+        lower, _ = nested_nodes(0.05, 5, level - 1) if level > 1 else \
+            ([], [])
+        assert len(points) == level_nodes(level)
+        assert set(lower) <= set(points)
+        _, fejer = nested_nodes(0.05, 5, level, 'fejer')
+        assert np.all(fejer > 0) and abs(np.sum(fejer) - 1) < 1e-12
+        assert np.all(weights > 0)
+
+
+@pytest.mark.parametrize('rule', ['adaptive', 'smolyak'])
+def test_sparse_grid_matches_tensor_rule(rule, tcdf):
+    state = random_state()
+    tol = 1e-3
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        result = vp.integrate_success_prob(
+            state[0], shipped_t_dist_params(), *state[1:], tcdf, tol,
+            rule=rule)
+    assert result['converged']
+
+    # as accurate as a tensor rule with ten times the nodes (96,040), and as
+    # close to the shipped tensor rule as that is (its 1,620 nodes are only
+    # accurate to about 1e-2)
+    assert result['evaluations'] <= 10000
+    refined = vp.chamber_success_prob(state[0],
+                                      shipped_t_dist_params(40, 7),
+                                      *state[1:], tcdf)
+    shipped = vp.chamber_success_prob(state[0], shipped_t_dist_params(),
+                                      *state[1:], tcdf)
+    assert abs(result['prob'] - refined) <= tol
+    assert abs(result['prob'] - shipped) <= abs(refined - shipped) + tol
+
+
+def test_pdf_weighted_draws():
+    # draws converge to what the pdf weighted rule converges to
+    points, weights = percentile_nodes(0.037, 3, 10001)
+    weights = weights / np.sum(weights)
+    draws = pdf_weighted_draws(np.random.default_rng(0), 0.037, 3, 200000)
+    for func in [np.abs, lambda x: x > 0.03, lambda x: x < -0.06]:
+        values = func(draws)
+        std_err = np.std(values) / np.sqrt(len(draws))
+        assert abs(np.mean(values) - weights.dot(func(points))) <= \
+            4 * std_err
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Forecast timeline: the probability of bipartisan control of every state for
+each day in a range of dates. The date only enters the model through the time
+decay of the degrees of freedom (see voter_power.time_decay_scale), so dates
+are grouped by the setting they map to, each distinct setting is run once
+(with the machinery of sweep.py, which shares prepared races and caches t cdf
+tables per degrees of freedom), and the results are spread back over the
+dates in one long table. By default each date gets exactly the value the
+model would publish on it; rounding the setting (scale_digits) and compact t
+cdf tables are opt-in, and make the values approximate.
+"""
+from datetime import timedelta
+import pandas as pd
+from voter_power import time_decay_scale
+from sweep import sweep
+
+
+def timeline_dates(start, election_day):
+    """ Every date from start to election_day, inclusive. """
+
+    return [start + timedelta(days=i) for i in
+            range((election_day - start).days + 1)]
+
+
+def timeline(prepared, err_df, dates, election_day, margin_col, voters_col,
+             threshold_col, tie_col, chamber_col, power_col, race_sigma=0.07,
+             race_deg_f=5, scale_digits=None, prob_only=True, processes=None,
+             compact=False):
+    ''' Runs every state for every date.
+
+    Arguments:
+        prepared: sweep.prepare_states output
+        err_df: DataFrame of correlated_error_parameters.csv
+        dates: list of dates (datetime.date) to run as the last update
+        election_day: date of the election
+        margin_col, voters_col, threshold_col, tie_col, chamber_col,
+            power_col: as in voter_power.state_voter_powers
+        race_sigma (optional): as in voter_power.state_voter_powers
+        race_deg_f (optional): degrees of freedom of the race error before
+            the time decay
+        scale_digits (optional): if set, round deg_f_scale to this many
+            digits, so that nearby dates share a setting (time_decay_scale
+            changes every day) at the cost of approximate values; None (the
+            default) runs every date as is, as redistricting_moneyball.py
+            would on that date
+        prob_only (optional): if False, also find voter powers, and compare
+            each date's ranking with that of the last date (see sweep.sweep)
+        processes (optional): as in sweep.sweep
+        compact (optional): as in sweep.sweep, but off by default so that
+            each date's values match redistricting_moneyball.py
+    Output: DataFrame with one row per date and state, with columns 'date',
+        'days_to_election', 'deg_f_scale', 'state', 'bipartisan_prob' and,
+        unless prob_only, 'rank_corr' and 'top_k_overlap'
+    '''
+
+    # the setting each date maps to
+    days = [(election_day - date).days for date in dates]
+    scales = [time_decay_scale(max(day, 0)) for day in days]
+    if scale_digits is not None:
+        scales = [round(scale, scale_digits) for scale in scales]
+
+    # run each distinct setting once, the last date's as the baseline
+    unique_scales = list(dict.fromkeys(reversed(scales)))
+    settings = [{'race_sigma': race_sigma, 'race_deg_f': race_deg_f,
+                 'deg_f_scale': scale} for scale in unique_scales]
+    results = sweep(prepared, err_df, settings, margin_col, voters_col,
+                    threshold_col, tie_col, chamber_col, power_col,
+                    prob_only=prob_only, processes=processes,
+                    compact=compact)
+    results = results.drop(columns=['race_sigma', 'race_deg_f',
+                                    'prob_change'])
+
+    # spread the results over the dates
+    dates_df = pd.DataFrame({'date': dates, 'days_to_election': days,
+                             'deg_f_scale': scales})
+    output = pd.merge(dates_df, results, how='left', on='deg_f_scale')
+    return output.sort_values(['date', 'state'], kind='stable').reset_index(
+        drop=True)
@@ -3,12 +3,22 @@
 Created on Thu Jun 11 14:04:26 2020
 @author: Jacob
 """
+import os
+import pandas as pd
 import scipy.stats as sts
 import numpy as np
-import itertools as it
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from quadrature import quadrature_rule, smolyak_integrate, adaptive_integrate
+from compiled import resolve_backend, compiled_probs_from_margins, \
+    compiled_tail_probs, compiled_node_success_probs
 
+# default cap on the number of elements in the (nodes x races) arrays that
+# node_success_probs works with at once
+MAX_CHUNK_ELEMENTS = 2**21
 
-def prob_from_margin(margin, race_sigma, race_deg_f, tcdf):
+
+def prob_from_margin(margin, race_sigma, race_deg_f, tcdf, backend='auto'):
     """ Given the expected margin of a race and the parameters determining the
     t-distribution about this margin, returns the probability of victory.
     Arguments:
@@ -18,23 +28,284 @@ def prob_from_margin(margin, race_sigma, race_deg_f, tcdf):
             actual win margin
         race_deg_f: positive integer, degrees of freedom used in t-distribution
         tcdf: t cumulative distribution function (precalculated to save time)
+        backend (optional): as in probs_from_margins
     Output: real number between 0 and 1, probability of candidate winning
     """
-    
-    try:
-        x = margin/race_sigma
-        ix = (x+50)/100 * (len(tcdf)-1)
-        floor_ix = int(np.floor(ix))
-        frac_ix = ix - floor_ix
-        return (1 - frac_ix) * tcdf[floor_ix] + frac_ix * tcdf[floor_ix + 1]
-    except:
-        return sts.t.cdf(margin / race_sigma, race_deg_f)
-
-
-def dem_chamber_power(margins, threshold, tie, race_sigma, race_deg_f, tcdf):
+
+    return probs_from_margins([margin], race_sigma, race_deg_f, tcdf,
+                              backend)[0]
+
+
+def probs_from_margins(margins, race_sigma, race_deg_f, tcdf, backend='auto'):
+    """ Vectorized version of prob_from_margin. Given an array of expected
+    margins (one race per element, e.g. a 1-D array of races or a 2-D array
+    of quadrature nodes by races), returns every probability of victory with
+    one linear interpolation over tcdf.
+    Arguments:
+        margins: numpy array of expected win margins for candidate (negative =
+            loss margin), any shape
+        race_sigma: positive real number, estimate of standard deviation of
+            actual win margin
+        race_deg_f: positive integer, degrees of freedom used in t-distribution
+        tcdf: t cumulative distribution function (precalculated to save time),
+            evaluated on an evenly spaced grid from -50 to 50
+        backend (optional): 'numba' to interpolate with the compiled kernel
+            (see compiled.py), 'numpy', or 'auto' for 'numba' if installed
+    Output: numpy array of the same shape as margins, probability of candidate
+        winning each race
+    """
+
+    # interpolate with the compiled kernel, which leaves NaN where the table
+    # does not cover a margin
+    x = np.asarray(margins, dtype=float) / race_sigma
+    if resolve_backend(backend) == 'numba':
+        probs = compiled_probs_from_margins(margins, race_sigma, tcdf)
+        out_of_range = np.isnan(probs)
+        if np.any(out_of_range):
+            probs[out_of_range] = sts.t.cdf(x[out_of_range], race_deg_f)
+        return probs
+
+    # find the (fractional) index of each standardized margin in tcdf
+    ix = (x + 50) / 100 * (len(tcdf) - 1)
+
+    # flag margins the table does not cover (this includes NaNs), we need
+    # both floor_ix and floor_ix + 1 to be valid indices to interpolate
+    out_of_range = ~((ix >= 0) & (ix < len(tcdf) - 1))
+
+    # interpolate linearly between neighboring points of tcdf
+    floor_ix = np.floor(np.where(out_of_range, 0, ix)).astype(np.intp)
+    frac_ix = ix - floor_ix
+    probs = (1 - frac_ix) * tcdf[floor_ix] + frac_ix * tcdf[floor_ix + 1]
+
+    # evaluate the flagged margins exactly
+    if np.any(out_of_range):
+        probs[out_of_range] = sts.t.cdf(x[out_of_range], race_deg_f)
+
+    return probs
+
+
+def seat_distribution_direct(probs):
+    """ Finds the probability distribution of seats won by multiplying the
+    polynomials lose_prob + win_prob*x of the races one at a time (the
+    original method, O(n^2) per chamber).
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+    Output: numpy array whose last axis has length races + 1, where element n
+        is the probability of winning exactly n seats
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    num_races = probs.shape[-1]
+
+    # a single chamber is quickest with np.convolve
+    if probs.ndim == 1:
+        seat_probs = np.asarray([1])
+        for p in probs:
+            seat_probs = np.convolve(seat_probs, [1 - p, p])
+        return seat_probs
+
+    # start with the polynomial 1 and multiply in one race at a time
+    seat_probs = np.zeros(probs.shape[:-1] + (num_races + 1,))
+    seat_probs[..., 0] = 1
+    for j in range(num_races):
+        p = probs[..., j, np.newaxis]
+        new_probs = seat_probs[..., :j + 2] * (1 - p)
+        new_probs[..., 1:] += seat_probs[..., :j + 1] * p
+        seat_probs[..., :j + 2] = new_probs
+
+    return seat_probs
+
+
+def _race_polys(probs):
+    """ Stacks the polynomials lose_prob + win_prob*x of the races along a new
+    second to last axis, padding with the polynomial 1 so that the number of
+    polynomials is a power of two (helper for the divide-and-conquer
+    methods).
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    num_races = probs.shape[-1]
+    num_polys = 1 << max(num_races - 1, 0).bit_length()
+
+    polys = np.zeros(probs.shape[:-1] + (num_polys, 2))
+    polys[..., 0] = 1
+    polys[..., :num_races, 0] = 1 - probs
+    polys[..., :num_races, 1] = probs
+    return polys
+
+
+def seat_distribution_pairwise(probs):
+    """ Finds the probability distribution of seats won by multiplying the
+    race polynomials pairwise in a divide-and-conquer tree, so that every
+    level of the tree is a handful of array operations.
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+    Output: numpy array whose last axis has length races + 1, where element n
+        is the probability of winning exactly n seats
+    """
+
+    num_races = np.shape(probs)[-1]
+    polys = _race_polys(probs)
+
+    # multiply neighboring polynomials until only one is left
+    while polys.shape[-2] > 1:
+        left = polys[..., 0::2, :]
+        right = polys[..., 1::2, :]
+        deg = polys.shape[-1] - 1
+        product = np.zeros(left.shape[:-1] + (2 * deg + 1,))
+        for i in range(deg + 1):
+            product[..., i:i + deg + 1] += left[..., i, np.newaxis] * right
+        polys = product
+
+    return polys[..., 0, :num_races + 1]
+
+
+def seat_distribution_fft(probs):
+    """ Finds the probability distribution of seats won by multiplying the
+    race polynomials pairwise in a divide-and-conquer tree, using FFTs for
+    each level of multiplications (O(n log^2 n) per chamber).
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+    Output: numpy array whose last axis has length races + 1, where element n
+        is the probability of winning exactly n seats
+    """
+
+    num_races = np.shape(probs)[-1]
+    polys = _race_polys(probs)
+
+    # multiply neighboring polynomials until only one is left
+    while polys.shape[-2] > 1:
+        size = 2 * polys.shape[-1] - 1
+        left = np.fft.rfft(polys[..., 0::2, :], n=size)
+        right = np.fft.rfft(polys[..., 1::2, :], n=size)
+        polys = np.fft.irfft(left * right, n=size)
+
+    # round-off can leave tiny negative probabilities, clip them to 0
+    return np.maximum(polys[..., 0, :num_races + 1], 0)
+
+
+def seat_distribution_blocks(probs):
+    """ Finds the probability distribution of seats won by grouping races
+    whose win probabilities are identical (at every node, i.e. races with the
+    same row of parameter_weights) into blocks. The seats won in a block of m
+    races are binomial, with the closed-form generating function
+    (lose_prob + win_prob*x)^m, so each block costs one operation however
+    many races it holds: the generating functions of all blocks are
+    multiplied at the roots of unity (adding up their logs) and inverted with
+    one FFT.
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+    Output: numpy array whose last axis has length races + 1, where element n
+        is the probability of winning exactly n seats
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    num_races = probs.shape[-1]
+
+    # group races with the same win probability at every node, keeping the
+    # first race and the size of each block
+    blocks = {}
+    columns = np.ascontiguousarray(probs.reshape(-1, num_races).T)
+    for ix, column in enumerate(columns):
+        first, count = blocks.get(column.tobytes(), (ix, 0))
+        blocks[column.tobytes()] = (first, count + 1)
+
+    # add up the log of each block's generating function at the roots of
+    # unity, lose_prob + win_prob*root to the power of the block size
+    size = num_races + 1
+    angles = 2 * np.pi * np.arange(size // 2 + 1) / size
+    log_size = np.zeros(probs.shape[:-1] + angles.shape)
+    phase = np.zeros(probs.shape[:-1] + angles.shape)
+    with np.errstate(divide='ignore'):
+        for ix, count in blocks.values():
+            p = probs[..., ix, np.newaxis]
+            real = 1 - p + p * np.cos(angles)
+            imag = -p * np.sin(angles)
+            log_size += count / 2 * np.log(real**2 + imag**2)
+            phase += count * np.arctan2(imag, real)
+
+    # invert the product, round-off can leave tiny negative probabilities,
+    # clip them to 0
+    transform = np.exp(log_size + 1j * phase)
+    return np.maximum(np.fft.irfft(transform, n=size), 0)
+
+
+# average number of races per block at which 'auto' picks the blocks method
+# (timed on 1,620 nodes: 150 races in 30 blocks take 0.08 s against 0.13 s
+# for direct, in 75 blocks 0.15 s against 0.12 s)
+MIN_BLOCK_SIZE = 5
+
+# methods available to seat_distribution, keyed by name
+SEAT_DISTRIBUTION_METHODS = {'direct': seat_distribution_direct,
+                             'pairwise': seat_distribution_pairwise,
+                             'fft': seat_distribution_fft,
+                             'blocks': seat_distribution_blocks}
+
+
+def seat_distribution(probs, method='auto', check=False, tol=1e-12):
+    """ Finds the probability distribution of seats won, assuming independence
+    of races (a Poisson binomial distribution), with a choice of method.
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+        method (optional): key of SEAT_DISTRIBUTION_METHODS, or 'auto' to
+            choose by the number of races in the chamber (and, for batches,
+            how many of them repeat, see MIN_BLOCK_SIZE)
+        check (optional): if True, compare the result against the direct
+            method and fail if any probability differs by more than tol
+        tol (optional): tolerance used when check is True
+    Output: numpy array whose last axis has length races + 1, where element n
+        is the probability of winning exactly n seats
+    """
+
+    # pick the fastest method for this size (timed on 1,620 quadrature nodes
+    # for batches, which amortize the per-race overhead of the direct method
+    # so that it beats fft up to about 320 races, past every real chamber
+    # but the NH house)
+    if method == 'auto':
+        num_races = np.shape(probs)[-1]
+        max_direct = 320 if np.ndim(probs) > 1 else 16
+        method = 'direct' if num_races <= max_direct else 'fft'
+
+        # blocks wins once races repeat enough (an average block of 5 or
+        # more); races identical at every node are identical at the first
+        if np.ndim(probs) > 1 and np.size(probs) > 0:
+            first_node = np.reshape(probs, (-1, num_races))[0]
+            if np.unique(first_node).size * MIN_BLOCK_SIZE <= num_races:
+                method = 'blocks'
+
+    seat_probs = SEAT_DISTRIBUTION_METHODS[method](probs)
+
+    # verify against the original method
+    if check and method != 'direct':
+        err = np.max(np.abs(seat_probs - seat_distribution_direct(probs)),
+                     initial=0)
+        assert err <= tol, (method, err)
+
+    return seat_probs
+
+
+def use_compiled(seat_method, backend):
+    """ Whether to run the compiled kernels (see compiled.py), which find the
+    probability of D power with the windowed recursion: only with the
+    'numba' backend and seat_method 'auto' or 'windowed', so that any other
+    seat method asked for is honored.
+    """
+
+    return isinstance(seat_method, str) and \
+        seat_method in ['auto', 'windowed'] and \
+        resolve_backend(backend) == 'numba'
+
+
+def dem_chamber_power(margins, threshold, tie, race_sigma, race_deg_f, tcdf,
+                      seat_method='auto', backend='auto'):
     ''' Given a list of expected win margins and the number of seats needed
     for Dem party to have redistricting power, find the probability
-    of the Dem party reaching that threshold. Relies on prob_from_margin
+    of the Dem party reaching that threshold. Relies on probs_from_margins
     and assumes independence of races.
     Arguments:
         margins: numpy array of expected win margins (between -1 and 1) for
@@ -46,32 +317,265 @@ def dem_chamber_power(margins, threshold, tie, race_sigma, race_deg_f, tcdf):
         race_deg_f: positive integer, degrees of freedom used in t-distribution
             in each race
         tcdf: t cumulative distribution function (precalculated to save time)
+        seat_method (optional): method used by seat_distribution, or
+            'windowed' to skip the full distribution of seats won (see
+            chamber_tail_prob_windowed), or a NormalApproximation
+        backend (optional): 'numba' to find the probability with the compiled
+            windowed recursion (see compiled.py) when seat_method is 'auto'
+            or 'windowed' (other methods always run with NumPy), 'numpy', or
+            'auto' for 'numba' if installed
     Output: probability that the party reaches the threshold number of seats,
             assuming independence of race outcomes
     '''
 
     # find probability of victory for each race
-    probs = [prob_from_margin(i, race_sigma, race_deg_f, tcdf) for i in margins]
+    probs = probs_from_margins(margins, race_sigma, race_deg_f, tcdf, backend)
+    if use_compiled(seat_method, backend):
+        assert threshold <= np.shape(probs)[-1], (threshold, probs)
+        return compiled_tail_probs(probs, threshold, tie)
+    if seat_method == 'windowed':
+        return chamber_tail_prob_windowed(probs, threshold, tie)
+    if isinstance(seat_method, NormalApproximation):
+        return seat_method.tail_prob(probs, threshold, tie)
 
     # Find full probability distribution of seats won, assuming independence
 
     # associate with each race a polynomial of the form lose_prob + win_prob*x
-    polys = [np.asarray([1 - p, p]) for p in probs]
-
-    # multiply all of these polynomials; the resulting coefficient of x^n
+    # and multiply all of these polynomials; the resulting coefficient of x^n
     # is the nth element of the list (index starting at 0), and is the
     # probability of winning exactly n seats
-    seat_probs = np.asarray([1])
-    for poly in polys:
-        seat_probs = np.convolve(seat_probs, poly)
+    seat_probs = seat_distribution(probs, seat_method)
 
     # return the probability of D redistricting power
-    assert threshold < len(seat_probs), (threshold, seat_probs)
-    return np.sum(seat_probs[threshold:]) - (1-tie)*seat_probs[threshold]
+    assert threshold < np.shape(seat_probs)[-1], (threshold, seat_probs)
+    return chamber_tail_prob(seat_probs, threshold, tie)
+
+
+def chamber_tail_prob(seat_probs, threshold, tie):
+    """ Given a probability distribution of seats won, find the probability of
+    D redistricting power.
+    Arguments:
+        seat_probs: numpy array whose last axis gives the probability of
+            winning exactly n seats (leading axes are handled in batch)
+        threshold: number of seats needed for D redistricting power
+        tie: probability of D power if they hit "threshold" on the mark
+    Output: probability of D power (numpy array over the leading axes)
+    """
+
+    return (np.sum(seat_probs[..., threshold:], axis=-1) -
+            (1-tie)*seat_probs[..., threshold])
+
+
+def chamber_tail_prob_windowed(probs, threshold, tie):
+    """ Finds the probability of D redistricting power directly from the win
+    probabilities, without the full distribution of seats won. Adding one
+    race at a time, only seat counts that can still end exactly on the
+    threshold are tracked: mass above the threshold is already won (kept in
+    one absorbing total) and mass too far below to reach it with the races
+    left is dropped, as it can no longer count. The result is exact, and each
+    race costs O(min(races so far, races left, threshold)) rather than
+    O(races so far), which saves the most when the threshold is far from the
+    middle of the chamber.
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+        threshold: number of seats needed for D redistricting power
+        tie: probability of D power if they hit "threshold" on the mark
+    Output: probability of D power (numpy array over the leading axes)
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    num_races = probs.shape[-1]
+    assert threshold <= num_races, (threshold, num_races)
+
+    # window[..., n] is the probability of exactly n seats so far, for the n
+    # that can still end on the threshold; won is the probability of more
+    # than threshold seats so far
+    window = np.zeros(probs.shape[:-1] + (threshold + 1,))
+    window[..., 0] = 1
+    won = np.zeros(probs.shape[:-1])
+
+    for k in range(num_races):
+        p = probs[..., k:k + 1]
+
+        # winning this race from the threshold is absorbed into won
+        won += window[..., threshold] * p[..., 0]
+
+        # update the seat counts that can still end on the threshold
+        low = max(0, threshold - (num_races - k - 1))
+        high = min(k + 1, threshold)
+        if low == 0:
+            window[..., 1:high + 1] = window[..., 1:high + 1] * (1 - p) + \
+                window[..., :high] * p
+            window[..., :1] *= 1 - p
+        else:
+            window[..., low:high + 1] = window[..., low:high + 1] * (1 - p) + \
+                window[..., low - 1:high] * p
+
+    return won + tie * window[..., threshold]
+
+
+def chamber_tail_prob_normal(probs, threshold, tie):
+    """ Approximates the probability of D redistricting power with the
+    refined normal approximation of the distribution of seats won, P(seats
+    <= k) ~ G((k + 0.5 - mean) / sd), where G(x) = Phi(x) + skew * (1 - x^2)
+    * phi(x) / 6, and bounds its error. The bound is the smaller of
+    - the Berry-Esseen bound on the normal approximation (0.56 times the sum
+      of third absolute central moments over sd^3) plus the size of the
+      skewness correction, and
+    - a Bernstein bound on the tail the threshold is in: if it is above the
+      mean, the probability of D power is between 0 and exp(-a^2 / (2 (var +
+      a / 3))), a being the distance from the mean (and similarly below), so
+      the approximation can be no further off than that.
+    The second makes the bound small at nodes where the chamber is all but
+    decided, which is most nodes for large chambers.
+    Arguments:
+        probs: numpy array of win probabilities, the last axis indexes races
+            (any leading axes, e.g. quadrature nodes, are handled in batch)
+        threshold: number of seats needed for D redistricting power
+        tie: probability of D power if they hit "threshold" on the mark
+    Output: numpy arrays (over the leading axes) of the approximate
+        probability of D power and a bound on its absolute error
+    """
+
+    probs = np.asarray(probs, dtype=float)
+    variances = probs * (1 - probs)
+    mean = np.sum(probs, axis=-1)
+    var = np.sum(variances, axis=-1)
+    sd = np.sqrt(var)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = np.sum(variances * (1 - 2*probs), axis=-1) / sd**3
+        abs_moments = np.sum(variances * (probs**2 + (1 - probs)**2),
+                             axis=-1) / sd**3
+
+        # refined normal cdf (and the size of its skewness correction) just
+        # below and at the threshold
+        cdfs = []
+        corrections = []
+        for k in [threshold - 1, threshold]:
+            x = np.clip((k + 0.5 - mean) / sd, -40, 40)
+            correction = skew * (1 - x**2) * sts.norm.pdf(x) / 6
+            correction = np.where(sd > 0, correction, 0)
+            cdfs.append(np.clip(sts.norm.cdf(x) + correction, 0, 1))
+            corrections.append(np.abs(correction))
+    approx = 1 - tie * cdfs[0] - (1 - tie) * cdfs[1]
+    normal_bound = np.where(sd > 0, 0.56 * abs_moments + tie * corrections[0]
+                            + (1 - tie) * corrections[1], np.inf)
+
+    # Bernstein bound on the tail holding the threshold
+    dist = np.abs(threshold - mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tail = np.exp(-dist**2 / (2 * (var + dist / 3)))
+    tail = np.where(dist > 0, tail, 1)
+    off = np.where(threshold > mean, approx, 1 - approx)
+    tail_bound = np.maximum(off, tail - off)
+
+    return approx, np.minimum(normal_bound, tail_bound)
+
+
+class NormalApproximation():
+    """ Seat method (pass as seat_method to dem_chamber_power, or anything
+    that passes it on) that finds the probability of D power from the
+    refined normal approximation (see chamber_tail_prob_normal) at the nodes
+    where its error bound is within tol, and exactly elsewhere. Counts the
+    nodes taking each path over every call, so one instance per run records
+    how often the approximation was used. Where the full seat distributions
+    are needed (e.g. success_prob_increases), exact_method is used instead.
+
+    Attributes:
+        tol: largest error bound for which the approximation is used
+        exact_method: seat method used otherwise ('windowed' or a key of
+            SEAT_DISTRIBUTION_METHODS or 'auto')
+        min_races: chambers with fewer races are always found exactly
+        normal_nodes, exact_nodes: numbers of nodes that took each path
+    """
+
+    def __init__(self, tol=1e-6, exact_method='windowed', min_races=100):
+        self.tol = tol
+        self.exact_method = exact_method
+        self.min_races = min_races
+        self.normal_nodes = 0
+        self.exact_nodes = 0
+
+    def tail_prob(self, probs, threshold, tie):
+        """ Probability of D power in a chamber, as in
+        chamber_tail_prob_windowed.
+        """
+
+        probs = np.asarray(probs, dtype=float)
+        if probs.shape[-1] < self.min_races:
+            exact = np.ones(probs.shape[:-1], dtype=bool)
+            dem_prob = np.zeros(probs.shape[:-1])
+        else:
+            dem_prob, bound = chamber_tail_prob_normal(probs, threshold, tie)
+            exact = bound > self.tol
+
+        # fall back to the exact engine where the bound is too loose
+        if np.any(exact):
+            dem_prob[exact] = exact_tail_prob(probs[exact], threshold, tie,
+                                              self.exact_method)
+        self.exact_nodes += int(np.sum(exact))
+        self.normal_nodes += exact.size - int(np.sum(exact))
+        return dem_prob
+
+    def counts(self):
+        """ Numbers of nodes that took each path. """
+
+        return {'normal': self.normal_nodes, 'exact': self.exact_nodes}
+
+
+def exact_tail_prob(probs, threshold, tie, seat_method='auto'):
+    """ Exact probability of D power in a chamber from win probabilities,
+    with seat_method 'windowed' (see chamber_tail_prob_windowed) or any
+    method of seat_distribution.
+    """
+
+    if seat_method == 'windowed':
+        return chamber_tail_prob_windowed(probs, threshold, tie)
+    seat_probs = seat_distribution(probs, seat_method)
+    assert threshold < np.shape(seat_probs)[-1], (threshold, seat_probs)
+    return chamber_tail_prob(seat_probs, threshold, tie)
+
+
+def full_distribution_method(seat_method):
+    """ Seat method to use where the full distribution of seats won is
+    needed: 'windowed' falls back to 'auto' and a NormalApproximation to its
+    exact_method. Fails on names that are not seat methods.
+    """
+
+    if isinstance(seat_method, NormalApproximation):
+        seat_method = seat_method.exact_method
+    if seat_method == 'windowed':
+        seat_method = 'auto'
+    if seat_method != 'auto' and seat_method not in SEAT_DISTRIBUTION_METHODS:
+        raise ValueError('unknown seat method {!r}'.format(seat_method))
+    return seat_method
+
+
+def success_from_dem_probs(dem_prob_1, dem_prob_2, both_bad, neither_bad):
+    """ Given the probabilities of D power in each chamber (independent, e.g.
+    at a fixed correlated error), find the probability of a "good" outcome
+    (no single party control).
+    Arguments:
+        dem_prob_1, dem_prob_2: probabilities (or numpy arrays of them) of D
+            power in chamber 1 and chamber 2
+        both_bad: Boolean, is it bad if dems win both chambers?
+        neither_bad: Boolean, is it bad if dems win neither chamber?
+    Output: probability of a good outcome (same shape as the inputs)
+    """
+
+    good_outcome = 1
+    if both_bad:
+        good_outcome = good_outcome - dem_prob_1 * dem_prob_2
+    if neither_bad:
+        good_outcome = good_outcome - (1 - (dem_prob_1 + dem_prob_2) +
+                                       dem_prob_1 * dem_prob_2)
+    return good_outcome
 
 
 def success_prob_independence(chamber_1_params, chamber_2_params, race_sigma,
-                              race_deg_f, both_bad, neither_bad, tcdf):
+                              race_deg_f, both_bad, neither_bad, tcdf,
+                              seat_method='auto'):
     ''' Given two lists of expected win margins and thresholds for Dem party to
     have redistricting power, find the probability of a "good" outcome (no
     single party control). Relies on dem_chamber_power and assumes independence
@@ -87,6 +591,7 @@ def success_prob_independence(chamber_1_params, chamber_2_params, race_sigma,
         both_bad: Boolean, is it bad if dems win both chambers? (This happens
             if there is a D governor or governors have no veto power.)
         tcdf: t cumulative distribution function (precalculated to save time)
+        seat_method (optional): method used by seat_distribution
     '''
 
     # initialize two-element array of dem control prob of each chamber
@@ -106,7 +611,7 @@ def success_prob_independence(chamber_1_params, chamber_2_params, race_sigma,
         else:
             # find dem chamber power probability and append to win_probs
             p = dem_chamber_power(margins, threshold, tie, race_sigma,
-                                  race_deg_f, tcdf)
+                                  race_deg_f, tcdf, seat_method)
             dem_probs.append(p)
 
     # find the probability that we have a good outcome
@@ -119,9 +624,281 @@ def success_prob_independence(chamber_1_params, chamber_2_params, race_sigma,
     return good_outcome
 
 
+def chamber_node_states(margins, threshold_1, threshold_2, tie_1, tie_2,
+                        chamber_2_ix, race_sigma, race_deg_f, tcdf,
+                        seat_method='auto'):
+    ''' Given the expected margins of all races at a batch of nodes (values of
+    the correlated errors), find the win probabilities, seat distributions and
+    probability of D power of each chamber at every node.
+
+    Arguments:
+        margins: numpy array of expected win margins, one row per node and one
+            column per race (chamber 1 races first)
+        threshold_1, threshold_2, tie_1, tie_2, chamber_2_ix, race_sigma,
+            race_deg_f, tcdf: as in chamber_success_prob
+        seat_method (optional): method used by seat_distribution, or
+            'windowed' (see chamber_tail_prob_windowed) or a
+            NormalApproximation to find only the probability of D power,
+            leaving 'seat_probs' None
+    Output: list with a dictionary for each chamber, with keys
+        'start': column of margins where the chamber's races begin
+        'threshold', 'tie': threshold and tie probability of the chamber
+        'probs': win probability of each race at each node (None if the
+            chamber is not in question)
+        'seat_probs': distribution of seats won at each node (None if the
+            chamber is not in question)
+        'dem_prob': probability of D power at each node
+    '''
+
+    num_nodes = len(margins)
+    states = []
+    for start, stop, threshold, tie in [(0, chamber_2_ix, threshold_1, tie_1),
+                                        (chamber_2_ix, margins.shape[1],
+                                         threshold_2, tie_2)]:
+        state = {'start': start, 'threshold': threshold, 'tie': tie,
+                 'probs': None, 'seat_probs': None}
+
+        # 'D' or 'R' codes a chamber that is not in question
+        if threshold == 'D':
+            state['dem_prob'] = np.ones(num_nodes)
+        elif threshold == 'R':
+            state['dem_prob'] = np.zeros(num_nodes)
+        else:
+            state['probs'] = probs_from_margins(margins[:, start:stop],
+                                                race_sigma, race_deg_f, tcdf)
+            if seat_method == 'windowed':
+                state['dem_prob'] = chamber_tail_prob_windowed(
+                    state['probs'], threshold, tie)
+                states.append(state)
+                continue
+            if isinstance(seat_method, NormalApproximation):
+                state['dem_prob'] = seat_method.tail_prob(state['probs'],
+                                                          threshold, tie)
+                states.append(state)
+                continue
+            state['seat_probs'] = seat_distribution(state['probs'],
+                                                    seat_method)
+            assert threshold < state['seat_probs'].shape[-1], threshold
+            state['dem_prob'] = chamber_tail_prob(state['seat_probs'],
+                                                  threshold, tie)
+        states.append(state)
+
+    return states
+
+
+def tail_prob_sensitivity(seat_probs, probs, threshold, tie):
+    ''' Finds how fast the probability of D power in a chamber changes with
+    the win probability of each of a set of its races. The probability of D
+    power is linear in each race's win probability, with slope
+    tie * q[threshold - 1] + (1 - tie) * q[threshold], where q is the seat
+    distribution of the other races. q is found by dividing the race's factor
+    lose_prob + win_prob*x out of the seat distribution, forward from 0 seats
+    when win_prob <= 0.5 and backward from the top otherwise, which keeps the
+    division numerically stable. Only the two needed coefficients of q are
+    kept, so this is O(seats) per race and node.
+
+    Arguments:
+        seat_probs: numpy array of seat distributions, one row per node
+        probs: numpy array of win probabilities, one row per node and one
+            column per race of interest (all in this chamber)
+        threshold: number of seats needed for D redistricting power
+        tie: probability of D power if they hit "threshold" on the mark
+    Output: numpy array the shape of probs, derivative of the probability of D
+        power with respect to each race's win probability at each node
+    '''
+
+    num_seats = seat_probs.shape[-1] - 1
+    seat_probs = seat_probs[:, :, np.newaxis]
+
+    # forward division for races more likely lost than won (masked races use
+    # a harmless win probability so nothing overflows)
+    forward = probs <= 0.5
+    p = np.where(forward, probs, 0)
+    q = np.zeros(probs.shape)
+    for k in range(threshold + 1):
+        q_below = q
+        q = (seat_probs[:, k] - p * q) / (1 - p)
+    fwd_below, fwd_at = q_below, q
+
+    # backward division for the rest, starting from q[num_seats] = 0
+    p = np.where(forward, 1, probs)
+    q = np.zeros(probs.shape)
+    for k in range(num_seats, threshold - 1, -1):
+        q_above = q
+        q = (seat_probs[:, k] - (1 - p) * q) / p
+    bwd_below, bwd_at = q, q_above
+
+    q_below = np.where(forward, fwd_below, bwd_below)
+    q_at = np.where(forward, fwd_at, bwd_at)
+    return tie * q_below + (1 - tie) * q_at
+
+
+def tail_prob_gradient(probs, threshold, tie):
+    ''' Finds the probability of D power in a chamber and its derivative
+    with respect to every race's win probability in one forward and one
+    backward sweep over the races (reverse mode differentiation of the
+    recursion that adds one race at a time). The backward sweep finds
+    value[k][n], the probability of D power given n seats won in the first k
+    races (n > threshold counts as won); the forward sweep finds the
+    distribution of seats won in the first k - 1 races, and the derivative
+    with respect to race k is the sum over n of that distribution times
+    value[k][n + 1] - value[k][n]. Unlike tail_prob_sensitivity this never
+    divides, so it is stable for any win probabilities, at O(races *
+    threshold) per node.
+
+    Arguments:
+        probs: numpy array of win probabilities, one row per node and one
+            column per race
+        threshold: number of seats needed for D redistricting power
+        tie: probability of D power if they hit "threshold" on the mark
+    Output: numpy array with the probability of D power at each node, numpy
+        array the shape of probs of its derivative with respect to each win
+        probability
+    '''
+
+    num_nodes, num_races = probs.shape
+    assert threshold <= num_races, (threshold, num_races)
+
+    # backward sweep, value[k][:, n] for n from 0 to threshold + 1 seats
+    value = np.zeros((num_races + 1, num_nodes, threshold + 2))
+    value[num_races, :, threshold] = tie
+    value[:, :, threshold + 1] = 1
+    for k in range(num_races, 0, -1):
+        p = probs[:, k - 1:k]
+        value[k - 1, :, :-1] = (1 - p) * value[k, :, :-1] + \
+            p * value[k, :, 1:]
+
+    # forward sweep over the distribution of seats won so far (up to the
+    # threshold, more seats no longer matter)
+    grads = np.empty(probs.shape)
+    seats = np.zeros((num_nodes, threshold + 1))
+    seats[:, 0] = 1
+    for k in range(num_races):
+        grads[:, k] = np.sum(seats * (value[k + 1, :, 1:] -
+                                      value[k + 1, :, :-1]), axis=1)
+        p = probs[:, k:k + 1]
+        seats[:, 1:] = seats[:, 1:] * (1 - p) + seats[:, :-1] * p
+        seats[:, :1] *= 1 - p
+
+    return value[0, :, 0], grads
+
+
+def replace_race_prob(seat_probs, old_probs, new_probs):
+    ''' Updates seat distributions when the win probability of one of their
+    races changes, without multiplying the other races in again: the race's
+    factor lose_prob + win_prob*x is divided out (forward from 0 seats when
+    win_prob <= 0.5 and backward from the top otherwise, as in
+    tail_prob_sensitivity) and the new factor multiplied in. O(seats) per
+    node.
+
+    Arguments:
+        seat_probs: numpy array of seat distributions, one row per node
+        old_probs: numpy array of the race's win probability at each node
+        new_probs: numpy array of its new win probability at each node
+    Output: numpy array of the updated seat distributions
+    '''
+
+    num_seats = seat_probs.shape[-1] - 1
+    forward = old_probs <= 0.5
+
+    # divide forward (masked nodes use a harmless win probability)
+    p = np.where(forward, old_probs, 0)
+    fwd = np.zeros(seat_probs.shape[:-1] + (num_seats,))
+    q = 0
+    for k in range(num_seats):
+        q = (seat_probs[..., k] - p * q) / (1 - p)
+        fwd[..., k] = q
+
+    # divide backward, starting from the top
+    p = np.where(forward, 1, old_probs)
+    bwd = np.zeros(fwd.shape)
+    q = 0
+    for k in range(num_seats, 0, -1):
+        q = (seat_probs[..., k] - (1 - p) * q) / p
+        bwd[..., k - 1] = q
+    others = np.where(forward[..., np.newaxis], fwd, bwd)
+
+    # multiply in the new factor
+    new_seat_probs = np.zeros(seat_probs.shape)
+    new_seat_probs[..., :-1] = others * (1 - new_probs[..., np.newaxis])
+    new_seat_probs[..., 1:] += others * new_probs[..., np.newaxis]
+    return new_seat_probs
+
+
+def node_success_probs(parameter_weights, shifts, threshold_1, threshold_2,
+                       tie_1, tie_2, chamber_2_ix, race_sigma, race_deg_f,
+                       both_bad, neither_bad, tcdf, seat_method='auto',
+                       chunk_size=None, backend='auto'):
+    ''' Finds the probability of chamber success at many values of the
+    correlated errors at once. The margins of all races at all nodes come from
+    a single matrix multiply, and the seat distributions of each chamber are
+    found in batch, chunk_size nodes at a time. With the 'numba' backend, the
+    whole loop over nodes runs compiled instead (see compiled.py).
+
+    Arguments:
+        parameter_weights: numpy matrix as in chamber_success_prob
+        shifts: numpy array with one row per node and one column per source of
+            correlated error (column i multiplies column i+1 of
+            parameter_weights)
+        threshold_1, threshold_2, tie_1, tie_2, chamber_2_ix, race_sigma,
+            race_deg_f, both_bad, neither_bad, tcdf: as in chamber_success_prob
+        seat_method (optional): method used by seat_distribution
+        chunk_size (optional): number of nodes to evaluate at once, defaults
+            to as many as fit in MAX_CHUNK_ELEMENTS elements per array
+        backend (optional): 'numba', 'numpy', or 'auto' for 'numba' if
+            installed ('numba' is only used with seat_method 'auto' or
+            'windowed', see use_compiled)
+    Output: numpy array with the probability of success at each node
+    '''
+
+    # append a column of ones to the shifts to add in the starting margin
+    shifts = np.asarray(shifts, dtype=float)
+    num_nodes = len(shifts)
+    shifts = np.hstack((np.ones((num_nodes, 1)), shifts))
+
+    # run the compiled node loop, redoing any nodes it could not evaluate
+    # (margins beyond the range of tcdf) with NumPy
+    if use_compiled(seat_method, backend):
+        success = compiled_node_success_probs(parameter_weights, shifts,
+                                              threshold_1, threshold_2, tie_1,
+                                              tie_2, chamber_2_ix, race_sigma,
+                                              both_bad, neither_bad, tcdf)
+        redo = np.isnan(success)
+        if np.any(redo):
+            success[redo] = node_success_probs(
+                parameter_weights, shifts[redo, 1:], threshold_1,
+                threshold_2, tie_1, tie_2, chamber_2_ix, race_sigma,
+                race_deg_f, both_bad, neither_bad, tcdf, seat_method,
+                chunk_size, 'numpy')
+        return success
+
+    # bound memory use by the number of races
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (len(parameter_weights) + 1))
+
+    success = np.empty(num_nodes)
+    for start in range(0, num_nodes, chunk_size):
+        stop = min(start + chunk_size, num_nodes)
+
+        # expected margins of every race at every node in this chunk
+        margins = shifts[start:stop].dot(parameter_weights.T)
+
+        # find dem chamber power probability at every node
+        states = chamber_node_states(margins, threshold_1, threshold_2, tie_1,
+                                     tie_2, chamber_2_ix, race_sigma,
+                                     race_deg_f, tcdf, seat_method)
+        success[start:stop] = success_from_dem_probs(states[0]['dem_prob'],
+                                                     states[1]['dem_prob'],
+                                                     both_bad, neither_bad)
+
+    return success
+
+
 def chamber_success_prob(parameter_weights, t_dist_params, threshold_1,
                          threshold_2, tie_1, tie_2, chamber_2_ix,
-                         race_sigma, race_deg_f, both_bad, neither_bad, tcdf):
+                         race_sigma, race_deg_f, both_bad, neither_bad, tcdf,
+                         seat_method='auto', batched=True, chunk_size=None,
+                         rule=None, backend='auto'):
     ''' Finds the probability of chamber success (redistricting power) for a
     state, accounting for various sources of correlated error
 
@@ -154,47 +931,38 @@ def chamber_success_prob(parameter_weights, t_dist_params, threshold_1,
             (This happens if there is a R governor or governors have no
             veto power.)
         tcdf: t cumulative distribution function (precalculated to save time)
+        seat_method (optional): method used by seat_distribution
+        batched (optional): if True, evaluate all nodes with
+            node_success_probs, otherwise loop over them one at a time
+        chunk_size (optional): number of nodes node_success_probs evaluates
+            at once
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of t_dist_params
+        backend (optional): backend of node_success_probs, if batched
     '''
 
-    # make sure at least one source of correlated error
-    n = len(t_dist_params)
-    assert n > 0, "no correlated error encoded"
-
-    # extract sigmas and deg_fs from t_dist_params
-    sigmas = [param[0][0] for param in t_dist_params]
-    deg_fs = [param[0][1] for param in t_dist_params]
-    num_nodes_list = [param[1] for param in t_dist_params]
-
-    # chose sampling points to estimate integration, Chebyshev nodes of
-    # percentile function on each distribution
-    sample_points = []
-    weights = []
-    for ix, sig in enumerate(sigmas):
-
-        # get percentiles of nodes
-        num_nodes = num_nodes_list[ix]
-        nodes = 2*np.linspace(1, num_nodes, num_nodes) - 1
-        nodes = np.cos(nodes * np.pi / (2 * num_nodes))
-        nodes = (1 + nodes)/2
-
-        # get points, append to list, and get distribution pdfs to
-        # weight all points
-        points_to_add = sts.t.ppf(nodes, deg_fs[ix], scale=sig)
-        sample_points.append(points_to_add)
-        weights.append(sts.t.pdf(points_to_add, deg_fs[ix], scale=sig))
-
-    # cartesian product to get all correlated errors at once, relative weights
-    all_shifts = list(it.product(*sample_points))
-    all_shifts = [list(i) for i in all_shifts]
-    all_weights = [np.prod(i) for i in list(it.product(*weights))]
+    # get quadrature nodes (shift vectors) and their relative weights
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
+    all_shifts = rule.shifts
+    all_weights = rule.weights
     total_weight = np.sum(all_weights)
 
+    # evaluate all shift vectors in batch
+    if batched:
+        success = node_success_probs(parameter_weights, all_shifts,
+                                     threshold_1, threshold_2, tie_1, tie_2,
+                                     chamber_2_ix, race_sigma, race_deg_f,
+                                     both_bad, neither_bad, tcdf, seat_method,
+                                     chunk_size, backend)
+        return np.dot(all_weights, success) / total_weight
+
     success_weight = 0
     for ix, shift_vector in enumerate(all_shifts):
 
         # find expected margins before independent race shift
         # append 1 at the beginning to add in the starting margin
-        margins = parameter_weights.dot(np.asarray([1] + shift_vector))
+        margins = parameter_weights.dot(np.concatenate(([1], shift_vector)))
 
         # generate list of parameters for the two chambers
         params_1 = [margins[:chamber_2_ix], threshold_1, tie_1]
@@ -203,7 +971,7 @@ def chamber_success_prob(parameter_weights, t_dist_params, threshold_1,
         # find success_prob
         success = success_prob_independence(params_1, params_2, race_sigma,
                                             race_deg_f, both_bad, neither_bad,
-                                            tcdf)
+                                            tcdf, seat_method)
 
         # add to weighted success probability
         success_weight += all_weights[ix] * success
@@ -211,9 +979,479 @@ def chamber_success_prob(parameter_weights, t_dist_params, threshold_1,
     return success_weight / total_weight
 
 
+def integrate_success_prob(parameter_weights, t_dist_params, threshold_1,
+                           threshold_2, tie_1, tie_2, chamber_2_ix,
+                           race_sigma, race_deg_f, both_bad, neither_bad, tcdf,
+                           tol, rule='adaptive', max_evals=100000,
+                           weighting='pdf', seat_method='auto',
+                           chunk_size=None):
+    ''' Finds the probability of chamber success like chamber_success_prob,
+    but integrates over the correlated errors with a sparse grid that is
+    refined until the requested absolute tolerance is met, instead of the
+    full tensor product of t_dist_params. This keeps the number of nodes
+    manageable as sources of correlated error are added.
+
+    Arguments:
+        parameter_weights, t_dist_params, threshold_1, threshold_2, tie_1,
+            tie_2, chamber_2_ix, race_sigma, race_deg_f, both_bad,
+            neither_bad, tcdf: as in chamber_success_prob (the number of nodes
+            in t_dist_params is ignored)
+        tol: requested absolute error of the probability of chamber success
+        rule (optional): 'adaptive' for a dimension-adaptive sparse grid,
+            'smolyak' for Smolyak sparse grids of increasing level
+        max_evals (optional): most nodes the adaptive rule may evaluate
+        weighting (optional): weighting of the one-dimensional rules, see
+            quadrature.nested_nodes ('pdf' converges to what the pdf weighted
+            rule of chamber_success_prob converges to as nodes are added,
+            'fejer' to the expectation over the t-distributions themselves,
+            a different quantity than the model reports)
+        seat_method, chunk_size (optional): as in node_success_probs
+    Output: dictionary with the probability of chamber success ('prob'), the
+        estimated absolute error ('error'), whether it met tol ('converged'),
+        the number of nodes evaluated ('evaluations') and the final rule
+        ('shifts', 'weights', which may be reused to find voter powers on the
+        same nodes)
+    '''
+
+    def success(shifts):
+        return node_success_probs(parameter_weights, shifts, threshold_1,
+                                  threshold_2, tie_1, tie_2, chamber_2_ix,
+                                  race_sigma, race_deg_f, both_bad,
+                                  neither_bad, tcdf, seat_method, chunk_size)
+
+    if rule == 'smolyak':
+        return smolyak_integrate(success, t_dist_params, tol,
+                                 weighting=weighting)
+    return adaptive_integrate(success, t_dist_params, tol, max_evals,
+                              weighting=weighting)
+
+
+def joint_seat_distribution(parameter_weights, t_dist_params, chamber_2_ix,
+                            race_sigma, race_deg_f, tcdf, seat_method='auto',
+                            chunk_size=None, rule=None):
+    ''' Finds the joint distribution of seats won in the two chambers,
+    integrated over the correlated errors. At each node the chambers are
+    independent, so the joint distribution is the weighted sum over nodes of
+    the outer products of the two seat distributions (one matrix product).
+
+    Arguments:
+        parameter_weights, t_dist_params, chamber_2_ix, race_sigma,
+            race_deg_f, tcdf: as in chamber_success_prob
+        seat_method (optional): method used by seat_distribution (this needs
+            the full seat distributions, see full_distribution_method)
+        chunk_size (optional): number of nodes to evaluate at once
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of t_dist_params
+    Output: numpy array with one row per number of chamber 1 seats won and
+        one column per number of chamber 2 seats won (from 0), giving the
+        probability of each pair
+    '''
+
+    seat_method = full_distribution_method(seat_method)
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
+    num_nodes = len(rule)
+    num_races = len(parameter_weights)
+
+    # bound memory use by the number of races
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (num_races + 1))
+
+    joint = np.zeros((chamber_2_ix + 1, num_races - chamber_2_ix + 1))
+    for start in range(0, num_nodes, chunk_size):
+        stop = min(start + chunk_size, num_nodes)
+        margins = rule.design[start:stop].dot(parameter_weights.T)
+        probs = probs_from_margins(margins, race_sigma, race_deg_f, tcdf)
+        seat_probs_1 = seat_distribution(probs[:, :chamber_2_ix], seat_method)
+        seat_probs_2 = seat_distribution(probs[:, chamber_2_ix:], seat_method)
+        joint += (seat_probs_1 * rule.weights[start:stop, np.newaxis]).T.dot(
+            seat_probs_2)
+
+    return joint
+
+
+def node_dem_probs(parameter_weights, design, start, stop, threshold, tie,
+                   race_sigma, race_deg_f, tcdf, seat_method='auto',
+                   chunk_size=None):
+    ''' Finds the probability of D power in one chamber at every node.
+
+    Arguments:
+        parameter_weights: numpy matrix as in chamber_success_prob
+        design: numpy array of nodes with a column of ones prepended (see
+            quadrature.QuadratureRule)
+        start, stop: rows of parameter_weights holding the chamber's races
+        threshold, tie: threshold ('D' or 'R' if the chamber is not in
+            question) and tie probability of the chamber
+        race_sigma, race_deg_f, tcdf: as in chamber_success_prob
+        seat_method (optional): method used by dem_chamber_power
+        chunk_size (optional): number of nodes to evaluate at once
+    Output: numpy array with the probability of D power at each node
+    '''
+
+    num_nodes = len(design)
+    if threshold == 'D':
+        return np.ones(num_nodes)
+    if threshold == 'R':
+        return np.zeros(num_nodes)
+
+    # bound memory use by the number of races
+    chamber_weights = parameter_weights[start:stop]
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (stop - start + 1))
+
+    dem_prob = np.empty(num_nodes)
+    for lo in range(0, num_nodes, chunk_size):
+        hi = min(lo + chunk_size, num_nodes)
+        margins = design[lo:hi].dot(chamber_weights.T)
+        dem_prob[lo:hi] = dem_chamber_power(margins, threshold, tie,
+                                            race_sigma, race_deg_f, tcdf,
+                                            seat_method)
+    return dem_prob
+
+
+def success_prob_changes(parameter_weights, t_dist_params, threshold_1,
+                         threshold_2, tie_1, tie_2, chamber_2_ix, race_sigma,
+                         race_deg_f, both_bad, neither_bad, tcdf, races,
+                         margin_changes, seat_method='auto', chunk_size=None,
+                         rule=None):
+    ''' Finds how much the probability of chamber success changes when the
+    margin of each of a list of races changes (one race at a time), by
+    re-running the integration. Changing a race leaves the probability of D
+    power in the other chamber unchanged at every node, so the baseline
+    probabilities of both chambers are found once and only the chamber of
+    the changed race is recomputed.
+
+    Arguments:
+        parameter_weights, t_dist_params, threshold_1, threshold_2, tie_1,
+            tie_2, chamber_2_ix, race_sigma, race_deg_f, both_bad,
+            neither_bad, tcdf: as in chamber_success_prob
+        races: list of row indices of parameter_weights to change (in a
+            chamber that is in question)
+        margin_changes: list of the change in margin of each of these races
+        seat_method (optional): method used by dem_chamber_power
+        chunk_size (optional): number of nodes to evaluate at once
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of t_dist_params
+    Output: numpy array with the change in probability of chamber success
+        for each race
+    '''
+
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
+    chambers = [(0, chamber_2_ix, threshold_1, tie_1),
+                (chamber_2_ix, len(parameter_weights), threshold_2, tie_2)]
+
+    # find (and keep) the probability of D power in each chamber at every
+    # node, and the probability of success
+    baseline = [node_dem_probs(parameter_weights, rule.design, *chamber,
+                               race_sigma, race_deg_f, tcdf, seat_method,
+                               chunk_size)
+                for chamber in chambers]
+    prob = rule.weights.dot(success_from_dem_probs(*baseline, both_bad,
+                                                   neither_bad))
+
+    changes = []
+    for race, margin_change in zip(races, margin_changes):
+
+        # change the margin of this race
+        param_weights_copy = parameter_weights.copy()
+        param_weights_copy[race, 0] += margin_change
+
+        # recompute only the chamber holding this race
+        c = int(race >= chamber_2_ix)
+        dem_probs = list(baseline)
+        dem_probs[c] = node_dem_probs(param_weights_copy, rule.design,
+                                      *chambers[c], race_sigma, race_deg_f,
+                                      tcdf, seat_method, chunk_size)
+        success = success_from_dem_probs(*dem_probs, both_bad, neither_bad)
+        changes.append(rule.weights.dot(success) - prob)
+
+    return np.asarray(changes)
+
+
+def race_increases(state, success_slope, margins, weights, races,
+                   margin_changes, analytic, race_sigma, race_deg_f, tcdf,
+                   ix):
+    """ Weighted sum over a chunk of nodes of the change in the probability
+    of success from changing the margin of races[ix] (one at a time), all in
+    the chamber of state (a shard of the work of success_prob_increases).
+    The probability of success is linear in each race's win probability, so
+    the change is exact whatever the size of the margin change.
+
+    Arguments:
+        state: dictionary of the chamber at these nodes (see
+            chamber_node_states)
+        success_slope: numpy array of the change in probability of success
+            per unit change in the probability of D power in this chamber, at
+            each node
+        margins: numpy array of expected margins, one row per node and one
+            column per race
+        weights: numpy array of the weight of each node
+        races, margin_changes: numpy arrays of race indices (columns of
+            margins, repeats allowed) and the change in each one's margin
+            (1 / voters for one extra vote)
+        analytic, race_sigma, race_deg_f, tcdf: as in success_prob_increases
+        ix: indices into races of the races to evaluate
+    Output: numpy array with the weighted sum for each race in races[ix]
+    """
+
+    cham_races = races[ix]
+    probs = state['probs'][:, cham_races - state['start']]
+
+    # change in each race's win probability (or its derivative)
+    race_margins = margins[:, cham_races]
+    if analytic:
+        prob_changes = sts.t.pdf(race_margins / race_sigma,
+                                 race_deg_f) / race_sigma
+    else:
+        new_probs = probs_from_margins(race_margins + margin_changes[ix],
+                                       race_sigma, race_deg_f, tcdf)
+        prob_changes = new_probs - probs
+
+    # change in probability of D power in this chamber
+    dem_changes = prob_changes * tail_prob_sensitivity(
+        state['seat_probs'], probs, state['threshold'], state['tie'])
+
+    return weights.dot(dem_changes * success_slope[:, np.newaxis])
+
+
+def success_prob_increases(parameter_weights, t_dist_params, threshold_1,
+                           threshold_2, tie_1, tie_2, chamber_2_ix,
+                           race_sigma, race_deg_f, both_bad, neither_bad, tcdf,
+                           races, num_voters, analytic=False,
+                           seat_method='auto', chunk_size=None, rule=None,
+                           return_prob=False, workers=None):
+    ''' Finds how much the probability of chamber success increases when the
+    party gains one vote in each of a list of races, without recomputing the
+    integration for each race. At every node the seat distributions are found
+    once; a race's win probability enters the probability of D power linearly
+    (see tail_prob_sensitivity), and the probability of success is linear in
+    the probability of D power of each chamber, so the change at each node is
+    exact and costs O(seats).
+
+    Arguments:
+        parameter_weights, t_dist_params, threshold_1, threshold_2, tie_1,
+            tie_2, chamber_2_ix, race_sigma, race_deg_f, both_bad,
+            neither_bad, tcdf: as in chamber_success_prob
+        races: list of row indices of parameter_weights to perturb
+        num_voters: list of the number of voters in each of these races
+        analytic (optional): if True, return the derivative of the probability
+            of chamber success with respect to each race's margin instead
+        seat_method (optional): method used by seat_distribution (this needs
+            the full seat distributions, so 'windowed' falls back to 'auto'
+            and a NormalApproximation to its exact_method)
+        chunk_size (optional): number of nodes to evaluate at once
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of t_dist_params
+        return_prob (optional): if True, also return the probability of
+            chamber success itself, integrated from the same seat
+            distributions (saving a separate chamber_success_prob call)
+        workers (optional): number of threads to spread the races of each
+            chamber over (the baseline seat distributions at each node are
+            found once and shared by all threads)
+    Output: numpy array with the increase in probability of chamber success
+        for each race (or its derivative, if analytic), and the probability of
+        chamber success if return_prob
+    '''
+
+    races = np.asarray(races, dtype=int)
+    margin_changes = 1 / np.asarray(num_voters, dtype=float)
+    increases = np.zeros(len(races))
+    prob = 0
+    seat_method = full_distribution_method(seat_method)
+
+    # get quadrature nodes, with a column of ones for the margin
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
+    shifts = rule.design
+    weights = rule.weights
+    num_nodes = len(rule)
+
+    # bound memory use by the number of races
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // (len(parameter_weights) + 1))
+
+    # start worker threads if asked to
+    num_shards = workers or 1
+    pool = ThreadPoolExecutor(workers) if num_shards > 1 else None
+
+    for start in range(0, num_nodes, chunk_size):
+        stop = min(start + chunk_size, num_nodes)
+        margins = shifts[start:stop].dot(parameter_weights.T)
+        states = chamber_node_states(margins, threshold_1, threshold_2, tie_1,
+                                     tie_2, chamber_2_ix, race_sigma,
+                                     race_deg_f, tcdf, seat_method)
+        prob += weights[start:stop].dot(
+            success_from_dem_probs(states[0]['dem_prob'],
+                                   states[1]['dem_prob'], both_bad,
+                                   neither_bad))
+
+        for c, state in enumerate(states):
+            other_prob = states[1 - c]['dem_prob']
+
+            # find the races of interest in this chamber, skip it if it is
+            # not in question
+            if c == 0:
+                in_chamber = races < chamber_2_ix
+            else:
+                in_chamber = races >= chamber_2_ix
+            if state['seat_probs'] is None or not np.any(in_chamber):
+                continue
+
+            # change in probability of success, which is linear in the
+            # probability of D power in this chamber
+            success_slope = neither_bad * (1 - other_prob) - \
+                both_bad * other_prob
+
+            # split the races into shards, which worker threads evaluate
+            # against the same baseline seat distributions
+            cham_ix = np.flatnonzero(in_chamber)
+            shards = np.array_split(cham_ix, min(num_shards, len(cham_ix)))
+            shard_func = partial(race_increases, state, success_slope,
+                                 margins, weights[start:stop], races,
+                                 margin_changes, analytic, race_sigma,
+                                 race_deg_f, tcdf)
+            if pool is None:
+                shard_increases = map(shard_func, shards)
+            else:
+                shard_increases = pool.map(shard_func, shards)
+            for shard, shard_increase in zip(shards, shard_increases):
+                increases[shard] += shard_increase
+
+    if pool is not None:
+        pool.shutdown()
+    increases = increases / np.sum(weights)
+    if return_prob:
+        return increases, prob / np.sum(weights)
+    return increases
+
+
+def success_prob_gradient(parameter_weights, t_dist_params, threshold_1,
+                          threshold_2, tie_1, tie_2, chamber_2_ix, race_sigma,
+                          race_deg_f, both_bad, neither_bad, tcdf,
+                          chunk_size=None, rule=None):
+    ''' Finds the probability of chamber success and its gradient with
+    respect to the expected margin of every race, in one forward and backward
+    sweep per chamber at each node (see tail_prob_gradient), which costs
+    about two evaluations of the probability whatever the number of races.
+
+    Arguments:
+        parameter_weights, t_dist_params, threshold_1, threshold_2, tie_1,
+            tie_2, chamber_2_ix, race_sigma, race_deg_f, both_bad,
+            neither_bad, tcdf: as in chamber_success_prob
+        chunk_size (optional): number of nodes to evaluate at once, defaults
+            to as many as keep the sweeps within MAX_CHUNK_ELEMENTS elements
+        rule (optional): QuadratureRule to integrate with, by default the
+            (cached) tensor rule of t_dist_params
+    Output: numpy array with the derivative of the probability of chamber
+        success with respect to each race's margin (0 in chambers not in
+        question), and the probability of chamber success
+    '''
+
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
+    num_nodes = len(rule)
+    num_races = len(parameter_weights)
+    chambers = [(0, chamber_2_ix, threshold_1, tie_1),
+                (chamber_2_ix, num_races, threshold_2, tie_2)]
+
+    # bound memory use by the size of the backward sweep
+    if chunk_size is None:
+        sweep_size = max([(stop - start + 1) * (threshold + 2) for
+                          start, stop, threshold, _ in chambers if
+                          threshold not in ['D', 'R']], default=1)
+        chunk_size = max(1, MAX_CHUNK_ELEMENTS // max(sweep_size, num_races))
+
+    gradient = np.zeros(num_races)
+    prob = 0
+    for lo in range(0, num_nodes, chunk_size):
+        hi = min(lo + chunk_size, num_nodes)
+        weights = rule.weights[lo:hi]
+        margins = rule.design[lo:hi].dot(parameter_weights.T)
+
+        # probability of D power in each chamber and its gradient with
+        # respect to the chamber's win probabilities
+        dem_probs = []
+        grads = []
+        for start, stop, threshold, tie in chambers:
+            if threshold in ['D', 'R']:
+                dem_probs.append(np.full(hi - lo, float(threshold == 'D')))
+                grads.append(None)
+                continue
+            probs = probs_from_margins(margins[:, start:stop], race_sigma,
+                                       race_deg_f, tcdf)
+            dem_prob, grad = tail_prob_gradient(probs, threshold, tie)
+            dem_probs.append(dem_prob)
+            grads.append(grad)
+        prob += weights.dot(success_from_dem_probs(*dem_probs, both_bad,
+                                                   neither_bad))
+
+        # chain rule: success is linear in each chamber's probability of D
+        # power, and the win probability's derivative is the t pdf
+        for c, (start, stop, _, _) in enumerate(chambers):
+            if grads[c] is None:
+                continue
+            other_prob = dem_probs[1 - c]
+            success_slope = neither_bad * (1 - other_prob) - \
+                both_bad * other_prob
+            prob_slopes = sts.t.pdf(margins[:, start:stop] / race_sigma,
+                                    race_deg_f) / race_sigma
+            gradient[start:stop] += (weights * success_slope).dot(
+                grads[c] * prob_slopes)
+
+    return gradient, prob
+
+
+def decided_threshold(threshold, possible_seats):
+    """ Codes a chamber whose outcome is not in question: 'D' if D's already
+    won it (threshold <= 0), 'R' if R's already won it (threshold above the
+    number of competitive seats), otherwise the threshold itself.
+    """
+
+    if threshold <= 0:
+        return 'D'
+    if threshold > possible_seats:
+        return 'R'
+    return threshold
+
+
+class VoterPowerResult():
+    """ Everything found in one evaluation of a state's chambers, so that the
+    probability of bipartisan control and the voter powers come from the same
+    pass (see voter_power and state_voter_powers).
+
+    Attributes:
+        bipartisan_prob: real number between 0 and 1, probability of chamber
+            success (no single party control of redistricting)
+        districts: DataFrame of the districts evaluated, with the margins used
+            (and, from state_voter_powers, the columns they were blended
+            from) and the voter power column unless prob_only
+        margins: numpy array of the expected margin of each district used in
+            the evaluation
+        power_col: name of the voter power column (None if prob_only)
+    """
+
+    def __init__(self, bipartisan_prob, districts, margins, power_col=None):
+        self.bipartisan_prob = bipartisan_prob
+        self.districts = districts
+        self.margins = margins
+        self.power_col = power_col
+
+    @property
+    def powers(self):
+        """ Series of the voter power of each district (None if prob_only).
+        """
+
+        if self.power_col is None:
+            return None
+        return self.districts[self.power_col]
+
+
 def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
                 neither_bad, margin_col, voters_col, threshold_col, tie_col,
-                chamber_col, power_col, prob_only, tcdf):
+                chamber_col, power_col, prob_only, tcdf, seat_method='auto',
+                batched=True, chunk_size=None, power_method='incremental',
+                rule=None, workers=None):
     ''' Finds the power of one vote in each district (i.e. the increase in
     probability that the party reaches the necessary number of seats if they
     gain one extra vote)
@@ -243,11 +1481,31 @@ def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
             (This happens if there is a R governor or governors have no
             veto power.)
         tcdf: t cumulative distribution function (precalculated to save time)
-    Output: input DataFrame with one column added, power_col, which
-            gives the result of the calculation for each district'''
+        seat_method (optional): method used by seat_distribution
+        batched, chunk_size (optional): how chamber_success_prob evaluates
+            its quadrature nodes (see chamber_success_prob)
+        power_method (optional): how to find the effect of one extra vote,
+            'incremental' updates the baseline seat distributions at every
+            node (see success_prob_increases), 'analytic' uses the derivative
+            of the success probability with respect to the margin instead of
+            a one vote difference, 'gradient' finds that derivative for
+            every district at once (see success_prob_gradient) rather than
+            sharing it between districts with the same parameters, and
+            'finite_difference' re-runs the integration for each district
+            (slow, for verification; see success_prob_changes, or
+            chamber_success_prob if not batched)
+        rule (optional): QuadratureRule to integrate with (its columns must
+            follow the order of error_vars), by default the cached tensor rule
+            of error_vars
+        workers (optional): number of threads to spread the districts over
+            when finding voter powers (see success_prob_increases), for
+            states with many competitive seats
+    Output: VoterPowerResult with the probability of chamber success and
+        the input DataFrame with one column added, power_col, which gives the
+        result of the calculation for each district (unless prob_only)'''
 
     # generate parameter_weights
-    parameter_weights = districts_df[error_vars].to_numpy()
+    parameter_weights = districts_df[list(error_vars)].to_numpy()
 
     # append margins to the first column of parameter_weights
     margins = districts_df[margin_col].to_numpy()
@@ -257,8 +1515,10 @@ def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
     # get total_votes by district
     votes_by_district = list(districts_df[voters_col])
 
-    # extract sigmas, deg_fs from error_vars
+    # extract sigmas, deg_fs from error_vars and get the quadrature rule
     t_dist_params = list(error_vars.values())
+    if rule is None:
+        rule = quadrature_rule(t_dist_params)
 
     # find the first index of chamber 2 in margins and (parameter_weights)
     chambers = list(districts_df[chamber_col])
@@ -273,45 +1533,40 @@ def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
     tie_1 = ties[0]
     tie_2 = ties[-1]
 
-    # check if the race is already won in a chamber ##
-
-    # initialize some variables
-    test_cham_1 = True
-    test_cham_2 = True
-
-    # find number of competitive seats per chamber
-    possible_seats_1 = chamber_2_ix
-    possible_seats_2 = len(margins) - possible_seats_1
-
-    # if D's already won chamber 1
-    if threshold_1 <= 0:
-        test_cham_1 = False
-        threshold_1 = 'D'
-
-    # if R's already won chamber 1
-    elif threshold_1 > possible_seats_1:
-        test_cham_1 = False
-        threshold_1 = 'R'
-
-    # if D's already won chamber 2
-    if threshold_2 <= 0:
-        test_cham_2 = False
-        threshold_2 = 'D'
-
-    # if R's already won chamber 1
-    elif threshold_2 > possible_seats_2:
-        test_cham_2 = False
-        threshold_2 = 'R'
-
-    # find the chamber success probability
-    prob = chamber_success_prob(parameter_weights, t_dist_params, threshold_1,
-                                threshold_2, tie_1, tie_2, chamber_2_ix,
-                                race_sigma, race_deg_f, both_bad, neither_bad,
-                                tcdf)
+    # check if the race is already won in a chamber ('D' or 'R')
+    threshold_1 = decided_threshold(threshold_1, chamber_2_ix)
+    threshold_2 = decided_threshold(threshold_2, len(margins) - chamber_2_ix)
+    test_cham_1 = threshold_1 not in ['D', 'R']
+    test_cham_2 = threshold_2 not in ['D', 'R']
+
+    # find the chamber success probability, unless it can be found in the
+    # same pass as the voter powers (success_prob_increases)
+    single_pass = not prob_only and batched and \
+        power_method != 'finite_difference'
+    if not single_pass:
+        prob = chamber_success_prob(parameter_weights, t_dist_params,
+                                    threshold_1, threshold_2, tie_1, tie_2,
+                                    chamber_2_ix, race_sigma, race_deg_f,
+                                    both_bad, neither_bad, tcdf, seat_method,
+                                    batched, chunk_size, rule)
 
     # if we just cared about election results
     if prob_only:
-        return prob
+        return VoterPowerResult(prob, districts_df, margins.ravel())
+
+    # the gradient gives every district's power directly
+    if power_method == 'gradient':
+        gradient, prob = success_prob_gradient(parameter_weights,
+                                               t_dist_params, threshold_1,
+                                               threshold_2, tie_1, tie_2,
+                                               chamber_2_ix, race_sigma,
+                                               race_deg_f, both_bad,
+                                               neither_bad, tcdf, chunk_size,
+                                               rule)
+        districts_df[power_col] = gradient / np.asarray(votes_by_district,
+                                                        dtype=float)
+        return VoterPowerResult(prob, districts_df, margins.ravel(),
+                                power_col)
 
     # initialize dictionary keyed by parameter weights, where the value is
     # voter_power * voters_in_district, which is very nearly constant for
@@ -319,24 +1574,23 @@ def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
     # to cause < 0.1% error
     voter_power_dict = {}
 
-    # intitialize voter_powers list
-    voter_powers = []
+    # intitialize list of the unique parameters of each race (None if its
+    # chamber is not in doubt), and the first race with each set of them
+    race_params = []
+    first_races = {}
 
     # for all races
     for i in range(len(parameter_weights[:, 0])):
         # make sure the chamber is in doubt, if not assign voter power 0
         if i < chamber_2_ix:
             if not test_cham_1:
-                voter_powers.append(0)
+                race_params.append(None)
                 continue
         else:
             if not test_cham_2:
-                voter_powers.append(0)
+                race_params.append(None)
                 continue
 
-        # grab the number of voters in the district of interest
-        num_voters = votes_by_district[i]
-
         # grab relevant parameter weights for this race
         race_weights = list(parameter_weights[i, :])
 
@@ -346,33 +1600,74 @@ def voter_power(districts_df, error_vars, race_sigma, race_deg_f, both_bad,
         # together, the chamber and set of weights and give voter power
         # almost exactly inverse proportional to voters
         unique_params = tuple(race_weights + [chamber_bool])
-
-        # if we have not already done a race with these exact weights
-        # in this chamber
-        if unique_params not in voter_power_dict:
+        race_params.append(unique_params)
+
+        # remember the first race with these exact weights in this chamber
+        if unique_params not in first_races:
+            first_races[unique_params] = i
+
+    # find the increase in success probability from one extra vote in the
+    # first race of each set of parameters
+    races = list(first_races.values())
+    num_voters = [votes_by_district[i] for i in races]
+    if power_method == 'finite_difference' and batched:
+        increases = success_prob_changes(parameter_weights, t_dist_params,
+                                         threshold_1, threshold_2, tie_1,
+                                         tie_2, chamber_2_ix, race_sigma,
+                                         race_deg_f, both_bad, neither_bad,
+                                         tcdf, races,
+                                         [1 / i for i in num_voters],
+                                         seat_method, chunk_size, rule)
+
+    elif power_method == 'finite_difference':
+        increases = []
+        for i in races:
 
             # deep copy parameter_weights
             param_weights_copy = parameter_weights.copy()
 
             # adjust the margin in our race, assuming the party gained 1 vote
-            param_weights_copy[i, 0] += 1 / num_voters
+            param_weights_copy[i, 0] += 1 / votes_by_district[i]
 
             # find the chamber success probability
             prob_new = chamber_success_prob(param_weights_copy, t_dist_params,
                                             threshold_1, threshold_2, tie_1,
                                             tie_2, chamber_2_ix, race_sigma,
-                                            race_deg_f, both_bad, neither_bad, 
-                                            tcdf)
-
-            # update dictionary with quantity voter_power * voters_in_district
-            voter_power_dict[unique_params] = (prob_new - prob) * num_voters
-
-        # calcuate vote power, to later add to proper column of districts_df
-        voter_powers.append(voter_power_dict[unique_params] / num_voters)
+                                            race_deg_f, both_bad, neither_bad,
+                                            tcdf, seat_method, batched,
+                                            chunk_size, rule)
+            increases.append(prob_new - prob)
+
+    else:
+        increases = success_prob_increases(parameter_weights, t_dist_params,
+                                           threshold_1, threshold_2, tie_1,
+                                           tie_2, chamber_2_ix, race_sigma,
+                                           race_deg_f, both_bad, neither_bad,
+                                           tcdf, races, num_voters,
+                                           power_method == 'analytic',
+                                           seat_method, chunk_size, rule,
+                                           single_pass, workers)
+        if single_pass:
+            increases, prob = increases
+
+        # the derivative with respect to margin is already the (constant)
+        # quantity voter_power * voters_in_district
+        if power_method == 'analytic':
+            num_voters = [1] * len(races)
+
+    # update dictionary with quantity voter_power * voters_in_district
+    for unique_params, increase, voters in zip(first_races, increases,
+                                               num_voters):
+        voter_power_dict[unique_params] = increase * voters
+
+    # calcuate vote powers, to later add to proper column of districts_df
+    voter_powers = [0 if unique_params is None else
+                    voter_power_dict[unique_params] / votes_by_district[i]
+                    for i, unique_params in enumerate(race_params)]
 
     # add voter power column and return
     districts_df[power_col] = voter_powers
-    return districts_df
+    return VoterPowerResult(prob, districts_df, margins.ravel(), power_col)
 
 
 def rating_to_margin(favored, confidence, df):
@@ -400,11 +1695,193 @@ def rating_to_margin(favored, confidence, df):
     return margin
 
 
+def add_margins(races, margin_col, rating_to_margin_df,
+                found_margin_col=False, found_clip=False, blend_safe=False,
+                blend_else=False):
+    ''' Adds the margin column from the ratings of races, blended with a
+    foundational model if found_margin_col is passed.
+
+    Arguments:
+        races: DataFrame of races with 'favored' and 'confidence' columns
+        margin_col, rating_to_margin_df, found_margin_col, found_clip,
+            blend_safe, blend_else: as in state_voter_powers
+    Output: DataFrame of races with margin_col (and the columns it was
+        blended from) added
+    '''
+
+    st_races = races.copy()
+
+    # add margin column
+    st_races[margin_col] = st_races.apply(lambda x:
+                                          rating_to_margin(x.favored,
+                                                           x.confidence,
+                                                           rating_to_margin_df),
+                                          axis=1)
+
+    # adjust margin column based on foundational model
+    if found_margin_col:
+
+        # clip margins if needed
+        if found_clip:
+            st_races['unclipped_' + found_margin_col] = \
+                                        st_races[found_margin_col]
+            st_races[found_margin_col] = st_races.apply(lambda x: \
+                        min(x[found_margin_col], x[margin_col] + found_clip),\
+                        axis=1)
+            st_races[found_margin_col] = st_races.apply(lambda x: \
+                        max(x[found_margin_col], x[margin_col] - found_clip),\
+                        axis=1)
+
+        # blend margins
+        st_races['orig_' + margin_col] = st_races[margin_col]
+        st_races[margin_col] = st_races.apply(lambda x: blend_safe * \
+                    x[found_margin_col] + (1 - blend_safe) * x[margin_col] \
+                    if x['confidence'] == 'Safe' else blend_else * \
+                    x[found_margin_col] + (1 - blend_else) * x[margin_col],\
+                    axis=1)
+
+    return st_races
+
+
+def prepare_state_races(all_races, margin_col, threshold_col, tie_col,
+                        state, rating_to_margin_df, found_margin_col=False,
+                        found_clip=False, blend_safe=False, blend_else=False):
+    ''' Gets the contested races of a state, with thresholds adjusted for
+    uncontested seats and independents, and margins from the ratings (blended
+    with a foundational model if found_margin_col is passed).
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, state,
+            rating_to_margin_df, found_margin_col, found_clip, blend_safe,
+            blend_else: as in state_voter_powers
+    Output: DataFrame of the contested races in this state
+    '''
+
+    # restrict dataframe to this state
+    st_races = all_races[all_races['state'] == state].copy()
+
+    # find number of uncontested Dem seats in each chamber
+    d_uncont = {'lower': False, 'upper': False}
+    for chamber in d_uncont:
+        cham_df = st_races[st_races['office'] == chamber]
+        d_uncont[chamber] = sum(cham_df.apply(lambda x: x['favored'] == 'D' and
+                                              x['confidence'] == 'Uncontested',
+                                              axis=1))
+
+    # remove uncontested seats and update thresholds
+    st_races = st_races[st_races['confidence'] != 'Uncontested']
+    st_races[threshold_col] = st_races.apply(lambda x: x[threshold_col] -
+                                             d_uncont[x['office']], axis=1)
+
+    # remove safe and uncontested independents, lower threshold by 1 and
+    # cut tie prob in half (roughly, this assumes indies break to either
+    # party with equal probability in a redistricting coalition)
+    indies = st_races[(st_races['favored'] == 'I') &
+                      (st_races['confidence'].isin(['Safe', 'Uncontested']))]
+    for ix, row in indies.iterrows():
+        st_races[threshold_col] -= 1
+        st_races[tie_col] /= 0.5
+        st_races = st_races.drop(ix)
+
+    # add margin column, adjusted based on foundational model
+    st_races = add_margins(st_races, margin_col, rating_to_margin_df,
+                           found_margin_col, found_clip, blend_safe,
+                           blend_else)
+
+    return st_races
+
+
+def state_model(all_races, margin_col, threshold_col, tie_col, chamber_col,
+                state, error_vars, rating_to_margin_df, found_margin_col=False,
+                found_clip=False, blend_safe=False, blend_else=False):
+    ''' Gets what simulations and batches need to know about a state.
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, chamber_col, state,
+            error_vars, rating_to_margin_df, found_margin_col, found_clip,
+            blend_safe, blend_else: as in state_voter_powers
+    Output: dictionary with the state's 'parameter_weights' (as in
+        chamber_success_prob), 'chamber_2_ix', 'thresholds' and
+        'ties' of the two chambers ('D' or 'R' for a threshold that is not in
+        question), 'both_bad' and 'neither_bad'
+    '''
+
+    st_races = prepare_state_races(all_races, margin_col, threshold_col,
+                                   tie_col, state, rating_to_margin_df,
+                                   found_margin_col, found_clip, blend_safe,
+                                   blend_else)
+    chambers = list(st_races[chamber_col])
+    chamber_2_ix = chambers.index(chambers[-1])
+    thresholds = list(st_races[threshold_col])
+    ties = list(st_races[tie_col])
+
+    return {'parameter_weights':
+            st_races[[margin_col] + list(error_vars)].to_numpy(),
+            'chamber_2_ix': chamber_2_ix,
+            'thresholds': (decided_threshold(int(thresholds[0]),
+                                             chamber_2_ix),
+                           decided_threshold(int(thresholds[-1]),
+                                             len(chambers) - chamber_2_ix)),
+            'ties': (ties[0], ties[-1]),
+            'both_bad': bool(st_races['both_bad'].unique()[0]),
+            'neither_bad': bool(st_races['neither_bad'].unique()[0])}
+
+
+def state_options(state):
+    """ Blending options passed to state_voter_powers for a state (those
+    redistricting_moneyball.py runs with).
+    """
+
+    # no blending for NE, NC, all CNalysis (maps redrawn in 2018)
+    if state in ['NE', 'NC']:
+        return {}
+    return {'found_margin_col': 'found_margin', 'found_clip': 0.06,
+            'blend_safe': 0.75, 'blend_else': 0.5}
+
+
+def time_decay_scale(days_to_election):
+    """ How much to fatten the tails of the t-distributions (dividing their
+    degrees of freedom) given the number of days left to the election.
+    """
+
+    return 1 + min(1, 1/4*np.log(1 + days_to_election/20))
+
+
+def correlated_error_vars(err_df, deg_f_scale):
+    """ error_vars (see state_voter_powers) from the rows of
+    correlated_error_parameters.csv, with the degrees of freedom of decaying
+    parameters divided by deg_f_scale.
+    """
+
+    error_vars = {}
+    for _, row in err_df.iterrows():
+        sigma = row['sigma']
+        deg_f = row['deg_f']
+        if row['decay']:
+            deg_f /= deg_f_scale
+        error_vars[row['parameter']] = ((sigma, deg_f), row['nodes'])
+    return error_vars
+
+
+def race_error_parameters(path, race_sigma=0.07, race_deg_f=5):
+    """ Sigma and degrees of freedom (before any time decay) of the race
+    error, from the race_error_parameters.csv written by calibration.py, or
+    the values passed if there is no such file.
+    """
+
+    if not os.path.exists(path):
+        return race_sigma, race_deg_f
+    row = pd.read_csv(path).iloc[0]
+    return float(row['sigma']), float(row['deg_f'])
+
+
 def state_voter_powers(all_races, margin_col, voters_col, threshold_col,
                        tie_col, chamber_col, power_col, state, error_vars,
                        race_sigma, race_deg_f, rating_to_margin_df, tcdf,
                        found_margin_col=False, found_clip=False,
-                       blend_safe=False, blend_else=False, prob_only=False):
+                       blend_safe=False, blend_else=False, prob_only=False,
+                       seat_method='auto', batched=True, chunk_size=None,
+                       power_method='incremental', rule=None, workers=None):
     ''' Gets all voter powers in a state.
 
     Arguments:
@@ -443,66 +1920,32 @@ def state_voter_powers(all_races, margin_col, voters_col, threshold_col,
         rating_to_margin_df: pandas DataFrame with two columns, 'RATING' and
             'MARGIN' that give expected margin of victory associated with each
             rating
-        prob_only (optional): cuts function off early and just returns the
+        prob_only (optional): cuts function off early and just finds the
             probability of bipartisan control
         tcdf: t cumulative distribution function (precalculated to save time)
-
-    Output: DataFrame of races in this state with voter power column added
+        seat_method (optional): method used by seat_distribution to find
+            the distribution of seats won in each chamber ('windowed' skips
+            it where only the probability of D power is needed, as does a
+            NormalApproximation, which also counts the nodes it approximates)
+        batched, chunk_size (optional): how chamber_success_prob evaluates
+            its quadrature nodes (see chamber_success_prob)
+        power_method (optional): how voter_power finds the effect of one
+            extra vote ('incremental', 'analytic', 'gradient' or
+            'finite_difference')
+        rule (optional): QuadratureRule to integrate with, built once (e.g.
+            with quadrature.quadrature_rule) and shared by all states
+        workers (optional): number of threads to spread the districts of the
+            state over when finding voter powers
+
+    Output: VoterPowerResult with the probability of bipartisan control,
+        the DataFrame of races in this state (with the rating and blended
+        margins) with voter power column added, and the margins used
     '''
-    # restrict dataframe to this state
-    st_races = all_races[all_races['state'] == state].copy()
-
-    # find number of uncontested Dem seats in each chamber
-    d_uncont = {'lower': False, 'upper': False}
-    for chamber in d_uncont:
-        cham_df = st_races[st_races['office'] == chamber]
-        d_uncont[chamber] = sum(cham_df.apply(lambda x: x['favored'] == 'D' and
-                                              x['confidence'] == 'Uncontested',
-                                              axis=1))
-
-    # remove uncontested seats and update thresholds
-    st_races = st_races[st_races['confidence'] != 'Uncontested']
-    st_races[threshold_col] = st_races.apply(lambda x: x[threshold_col] -
-                                             d_uncont[x['office']], axis=1)
-
-    # remove safe and uncontested independents, lower threshold by 1 and
-    # cut tie prob in half (roughly, this assumes indies break to either
-    # party with equal probability in a redistricting coalition)
-    indies = st_races[(st_races['favored'] == 'I') &
-                      (st_races['confidence'].isin(['Safe', 'Uncontested']))]
-    for ix, row in indies.iterrows():
-        st_races[threshold_col] -= 1
-        st_races[tie_col] /= 0.5
-        st_races = st_races.drop(ix)
-
-    # add margin column
-    st_races[margin_col] = st_races.apply(lambda x:
-                                          rating_to_margin(x.favored,
-                                                           x.confidence,
-                                                           rating_to_margin_df),
-                                          axis=1)
-
-    # adjust margin column based on foundational model
-    if found_margin_col:
-
-        # clip margins if needed
-        if found_clip:
-            st_races['unclipped_' + found_margin_col] = \
-                                        st_races[found_margin_col]
-            st_races[found_margin_col] = st_races.apply(lambda x: \
-                        min(x[found_margin_col], x[margin_col] + found_clip),\
-                        axis=1)
-            st_races[found_margin_col] = st_races.apply(lambda x: \
-                        max(x[found_margin_col], x[margin_col] - found_clip),\
-                        axis=1)
-
-        # blend margins
-        st_races['orig_' + margin_col] = st_races[margin_col]
-        st_races[margin_col] = st_races.apply(lambda x: blend_safe * \
-                    x[found_margin_col] + (1 - blend_safe) * x[margin_col] \
-                    if x['confidence'] == 'Safe' else blend_else * \
-                    x[found_margin_col] + (1 - blend_else) * x[margin_col],\
-                    axis=1)
+    # restrict dataframe to this state, find margins and thresholds
+    st_races = prepare_state_races(all_races, margin_col, threshold_col,
+                                   tie_col, state, rating_to_margin_df,
+                                   found_margin_col, found_clip, blend_safe,
+                                   blend_else)
 
     # determine if it is bad for dems to win both
     both_bad = st_races['both_bad'].unique()[0]
@@ -511,8 +1954,155 @@ def state_voter_powers(all_races, margin_col, voters_col, threshold_col,
     neither_bad = st_races['neither_bad'].unique()[0]
 
     # calculate voter power, add column to df
-    st_races = voter_power(st_races, error_vars, race_sigma, race_deg_f,
-                           both_bad, neither_bad, margin_col, voters_col,
-                           threshold_col, tie_col, chamber_col, power_col,
-                           prob_only, tcdf)
-    return st_races
+    result = voter_power(st_races, error_vars, race_sigma, race_deg_f,
+                         both_bad, neither_bad, margin_col, voters_col,
+                         threshold_col, tie_col, chamber_col, power_col,
+                         prob_only, tcdf, seat_method, batched, chunk_size,
+                         power_method, rule, workers)
+    return result
+
+
+class JointSeatDistribution():
+    """ Joint distribution of seats won by Dems in the two chambers of a
+    state, against which any rule for redistricting power (thresholds, ties,
+    supermajorities, veto overrides) can be evaluated without integrating
+    again.
+
+    Attributes:
+        probs: numpy array, probs[i, j] is the probability of winning i
+            contested seats in chamber 1 and j in chamber 2
+        chambers: names of chamber 1 and chamber 2
+        seats: numpy arrays of the seats counted toward the thresholds in
+            each chamber for each row (column) of probs, i.e. contested seats
+            won plus uncontested D seats (and the independents adjustment of
+            prepare_state_races)
+        thresholds, ties, both_bad, neither_bad: the state's rule, used by
+            success_prob unless others are passed
+    """
+
+    def __init__(self, probs, chambers=('chamber 1', 'chamber 2'),
+                 seat_offsets=(0, 0), thresholds=(None, None),
+                 ties=(None, None), both_bad=None, neither_bad=None):
+        self.probs = probs
+        self.chambers = tuple(chambers)
+        self.seats = tuple(np.arange(size) + offset for size, offset in
+                           zip(probs.shape, seat_offsets))
+        self.thresholds = tuple(thresholds)
+        self.ties = tuple(ties)
+        self.both_bad = both_bad
+        self.neither_bad = neither_bad
+
+    def marginal(self, chamber):
+        """ Distribution of seats won in one chamber (0 or 1), over seats.
+        """
+
+        return self.probs.sum(axis=1 - chamber)
+
+    def dem_power(self, chamber, threshold, tie):
+        """ Probability of D power in a chamber (0 or 1) given the number of
+        seats won, for each entry of seats (as in voter_power, a threshold
+        every outcome meets or none can meet decides the chamber outright).
+        """
+
+        seats = self.seats[chamber]
+        if threshold <= seats[0]:
+            return np.ones(len(seats))
+        return np.where(seats > threshold, 1.0,
+                        np.where(seats == threshold, tie, 0.0))
+
+    def success_prob(self, threshold_1=None, threshold_2=None, tie_1=None,
+                     tie_2=None, both_bad=None, neither_bad=None):
+        """ Probability of chamber success (no single party control) under a
+        threshold rule, by default the state's.
+
+        Arguments:
+            threshold_1, threshold_2: seats needed for Dem power in each
+                chamber, counted as in seats
+            tie_1, tie_2: probability of D power if they hit the threshold on
+                the mark
+            both_bad, neither_bad: as in voter_power
+        Output: probability of chamber success
+        """
+
+        threshold_1 = self.thresholds[0] if threshold_1 is None else \
+            threshold_1
+        threshold_2 = self.thresholds[1] if threshold_2 is None else \
+            threshold_2
+        tie_1 = self.ties[0] if tie_1 is None else tie_1
+        tie_2 = self.ties[1] if tie_2 is None else tie_2
+        both_bad = self.both_bad if both_bad is None else both_bad
+        neither_bad = self.neither_bad if neither_bad is None else neither_bad
+
+        dem_1 = self.dem_power(0, threshold_1, tie_1)
+        dem_2 = self.dem_power(1, threshold_2, tie_2)
+        both = dem_1.dot(self.probs).dot(dem_2)
+        neither = (1 - dem_1).dot(self.probs).dot(1 - dem_2)
+        return 1 - both_bad * both - neither_bad * neither
+
+    def evaluate(self, outcome):
+        """ Probability of a good outcome under any rule.
+
+        Arguments:
+            outcome: function taking a column array of chamber 1 seats and a
+                row array of chamber 2 seats (counted as in seats) and
+                returning the probability of a good outcome for each pair
+                (broadcasting them), e.g. for a two thirds veto override
+        Output: probability of a good outcome
+        """
+
+        good = outcome(self.seats[0][:, np.newaxis],
+                       self.seats[1][np.newaxis, :])
+        return np.sum(self.probs * good)
+
+
+def state_joint_seat_distribution(all_races, margin_col, threshold_col,
+                                  tie_col, chamber_col, state, error_vars,
+                                  race_sigma, race_deg_f, rating_to_margin_df,
+                                  tcdf, found_margin_col=False,
+                                  found_clip=False, blend_safe=False,
+                                  blend_else=False, seat_method='auto',
+                                  chunk_size=None, rule=None):
+    ''' Gets the joint distribution of seats won in the two chambers of a
+    state, to evaluate redistricting rules against.
+
+    Arguments:
+        all_races, margin_col, threshold_col, tie_col, chamber_col, state,
+            error_vars, race_sigma, race_deg_f, rating_to_margin_df, tcdf,
+            found_margin_col, found_clip, blend_safe, blend_else,
+            chunk_size, rule: as in state_voter_powers
+        seat_method (optional): as in joint_seat_distribution
+    Output: JointSeatDistribution, with the state's thresholds (as in
+        all_races) and rule
+    '''
+
+    # restrict dataframe to this state, find margins and thresholds
+    st_races = prepare_state_races(all_races, margin_col, threshold_col,
+                                   tie_col, state, rating_to_margin_df,
+                                   found_margin_col, found_clip, blend_safe,
+                                   blend_else)
+    parameter_weights = st_races[[margin_col] + list(error_vars)].to_numpy()
+    t_dist_params = list(error_vars.values())
+    chambers = list(st_races[chamber_col])
+    chamber_2_ix = chambers.index(chambers[-1])
+
+    joint = joint_seat_distribution(parameter_weights, t_dist_params,
+                                    chamber_2_ix, race_sigma, race_deg_f,
+                                    tcdf, seat_method, chunk_size, rule)
+
+    # seats not in the table count toward the state's thresholds
+    thresholds = []
+    seat_offsets = []
+    ties = []
+    for chamber in [chambers[0], chambers[-1]]:
+        cham_races = st_races[st_races[chamber_col] == chamber]
+        orig_races = all_races[(all_races['state'] == state) &
+                               (all_races[chamber_col] == chamber)]
+        thresholds.append(orig_races[threshold_col].iloc[0])
+        seat_offsets.append(thresholds[-1] -
+                            cham_races[threshold_col].iloc[0])
+        ties.append(cham_races[tie_col].iloc[0])
+
+    return JointSeatDistribution(joint, (chambers[0], chambers[-1]),
+                                 seat_offsets, thresholds, ties,
+                                 st_races['both_bad'].unique()[0],
+                                 st_races['neither_bad'].unique()[0])
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+What-if sessions for exploring rating changes in one state. A session keeps
+the baseline integration of the state (win probabilities and seat
+distributions at every quadrature node), so that overriding the rating or
+margin of a few races only updates the seat distributions they enter,
+instead of re-running state_voter_powers, and the effect of shifting each
+race's rating one step either way is found for every race at once.
+"""
+import numpy as np
+import pandas as pd
+from quadrature import quadrature_rule
+from voter_power import prepare_state_races, add_margins, \
+    decided_threshold, chamber_node_states, chamber_tail_prob, \
+    success_from_dem_probs, probs_from_margins, replace_race_prob, \
+    race_increases, full_distribution_method, VoterPowerResult
+
+# CNalysis ratings in order from most R to most D
+RATING_SCALE = [('R', 'Safe'), ('R', 'Likely'), ('R', 'Lean'), ('R', 'Tilt'),
+                (False, 'Toss-Up'), ('D', 'Tilt'), ('D', 'Lean'),
+                ('D', 'Likely'), ('D', 'Safe')]
+
+
+class WhatIfSession():
+    """ Baseline of one state, against which overrides of race ratings or
+    margins are evaluated incrementally.
+
+    Attributes:
+        races: DataFrame of the contested races in the state (see
+            voter_power.prepare_state_races), indexed as in all_races
+        prob: baseline probability of bipartisan control
+        rule: QuadratureRule of the integration
+    """
+
+    def __init__(self, all_races, margin_col, voters_col, threshold_col,
+                 tie_col, chamber_col, power_col, state, error_vars,
+                 race_sigma, race_deg_f, rating_to_margin_df, tcdf,
+                 found_margin_col=False, found_clip=False, blend_safe=False,
+                 blend_else=False, seat_method='auto', rule=None):
+        ''' Integrates the baseline of a state.
+
+        Arguments:
+            all_races, margin_col, voters_col, threshold_col, tie_col,
+                chamber_col, power_col, state, error_vars, race_sigma,
+                race_deg_f, rating_to_margin_df, tcdf, found_margin_col,
+                found_clip, blend_safe, blend_else, rule: as in
+                voter_power.state_voter_powers
+            seat_method (optional): as in voter_power.state_voter_powers,
+                except that the session updates the full seat
+                distributions, so 'windowed' and a NormalApproximation fall
+                back to one (see voter_power.full_distribution_method)
+        '''
+
+        self.margin_col = margin_col
+        self.voters_col = voters_col
+        self.power_col = power_col
+        self.race_sigma = race_sigma
+        self.race_deg_f = race_deg_f
+        self.rating_to_margin_df = rating_to_margin_df
+        self.tcdf = tcdf
+        self.blending = (found_margin_col, found_clip, blend_safe, blend_else)
+
+        # restrict dataframe to this state, find margins and thresholds
+        self.races = prepare_state_races(all_races, margin_col,
+                                         threshold_col, tie_col, state,
+                                         rating_to_margin_df,
+                                         found_margin_col, found_clip,
+                                         blend_safe, blend_else)
+        self.both_bad = self.races['both_bad'].unique()[0]
+        self.neither_bad = self.races['neither_bad'].unique()[0]
+
+        # find the chambers and whether they are in question
+        chambers = list(self.races[chamber_col])
+        self.chamber_2_ix = chambers.index(chambers[-1])
+        num_races = len(chambers)
+        thresholds = list(self.races[threshold_col])
+        ties = list(self.races[tie_col])
+        threshold_1 = decided_threshold(int(thresholds[0]), self.chamber_2_ix)
+        threshold_2 = decided_threshold(int(thresholds[-1]),
+                                        num_races - self.chamber_2_ix)
+
+        # integrate the baseline, keeping every node
+        if rule is None:
+            rule = quadrature_rule(list(error_vars.values()))
+        self.rule = rule
+        parameter_weights = self.races[[margin_col] +
+                                       list(error_vars)].to_numpy()
+        self.margins = rule.design.dot(parameter_weights.T)
+        self.states = chamber_node_states(self.margins, threshold_1,
+                                          threshold_2, ties[0], ties[-1],
+                                          self.chamber_2_ix, race_sigma,
+                                          race_deg_f, tcdf,
+                                          full_distribution_method(
+                                              seat_method))
+        self.prob = self._success_prob(self.states)
+
+    def _success_prob(self, states):
+        success = success_from_dem_probs(states[0]['dem_prob'],
+                                         states[1]['dem_prob'],
+                                         self.both_bad, self.neither_bad)
+        return self.rule.weights.dot(success)
+
+    def override_margins(self, overrides):
+        """ Finds the margins of races under rating or margin overrides.
+
+        Arguments:
+            overrides: dictionary keyed by index (of all_races) of the races
+                to change, with values either a new margin or a new rating
+                as a (favored, confidence) tuple, e.g. ('R', 'Tilt'), which
+                is turned into a margin (and blended) as in the baseline
+        Output: DataFrame of races with the overrides applied
+        """
+
+        races = self.races.copy()
+        for label, override in overrides.items():
+            if not isinstance(override, tuple):
+                races.loc[label, self.margin_col] = override
+                continue
+
+            # redo the margin of this race from its new rating, starting
+            # from the unclipped foundational margin
+            assert override[1] != 'Uncontested', \
+                "uncontested seats change the thresholds, re-run the state"
+            race = self.races.loc[[label]].copy()
+            race['favored'], race['confidence'] = override
+            found_margin_col, found_clip = self.blending[:2]
+            if found_margin_col and found_clip:
+                race[found_margin_col] = race['unclipped_' + found_margin_col]
+            race = add_margins(race, self.margin_col,
+                               self.rating_to_margin_df, *self.blending)
+            races.loc[label, race.columns] = race.iloc[0]
+
+        return races
+
+    def evaluate(self, overrides, powers=False):
+        """ Finds the probability of bipartisan control (and optionally the
+        voter powers) under rating or margin overrides. Only the seat
+        distributions of the chambers holding changed races are updated, one
+        race at a time (see voter_power.replace_race_prob), so this takes
+        milliseconds; voter powers take one pass over the races in question.
+        Overrides are always applied to the baseline, not to earlier calls.
+
+        Arguments:
+            overrides: dictionary of overrides (see override_margins)
+            powers (optional): if True, also find the voter power of every
+                race (the exact one vote change, found for each race rather
+                than shared between races with identical parameters)
+        Output: VoterPowerResult
+        """
+
+        races = self.override_margins(overrides)
+        changes = races[self.margin_col].to_numpy() - \
+            self.races[self.margin_col].to_numpy()
+        changed = np.flatnonzero(changes)
+
+        # update the chambers holding the changed races
+        margins = self.margins
+        if len(changed) > 0:
+            margins = margins.copy()
+            margins[:, changed] += changes[changed]
+        bounds = [(0, self.chamber_2_ix), (self.chamber_2_ix, len(races))]
+        states = []
+        for state, (start, stop) in zip(self.states, bounds):
+            in_chamber = changed[(changed >= start) & (changed < stop)]
+            if state['probs'] is None or len(in_chamber) == 0:
+                states.append(state)
+                continue
+
+            state = dict(state)
+            state['probs'] = state['probs'].copy()
+            for i in in_chamber:
+                new_probs = probs_from_margins(margins[:, i], self.race_sigma,
+                                               self.race_deg_f, self.tcdf)
+                state['seat_probs'] = replace_race_prob(
+                    state['seat_probs'], state['probs'][:, i - start],
+                    new_probs)
+                state['probs'][:, i - start] = new_probs
+            state['dem_prob'] = chamber_tail_prob(state['seat_probs'],
+                                                  state['threshold'],
+                                                  state['tie'])
+            states.append(state)
+
+        prob = self._success_prob(states)
+        if not powers:
+            return VoterPowerResult(prob, races,
+                                    races[self.margin_col].to_numpy())
+
+        # find the increase from one vote in every race in question
+        all_races = np.arange(len(races))
+        num_voters = races[self.voters_col].to_numpy(dtype=float)
+        races[self.power_col] = self._increases(states, margins, all_races,
+                                                1 / num_voters)
+        return VoterPowerResult(prob, races,
+                                races[self.margin_col].to_numpy(),
+                                self.power_col)
+
+    def _increases(self, states, margins, races, margin_changes):
+        """ Change in the probability of success from changing the margin
+        of each of races (positions, repeats allowed) by margin_changes, one
+        at a time, 0 for races in chambers that are not in question.
+        """
+
+        increases = np.zeros(len(races))
+        bounds = [(0, self.chamber_2_ix), (self.chamber_2_ix, len(self.races))]
+        for c, (state, (start, stop)) in enumerate(zip(states, bounds)):
+            ix = np.flatnonzero((races >= start) & (races < stop))
+            if state['probs'] is None or len(ix) == 0:
+                continue
+            other_prob = states[1 - c]['dem_prob']
+            success_slope = self.neither_bad * (1 - other_prob) - \
+                self.both_bad * other_prob
+            increases[ix] = race_increases(state, success_slope, margins,
+                                           self.rule.weights, races,
+                                           margin_changes, False,
+                                           self.race_sigma, self.race_deg_f,
+                                           self.tcdf, ix)
+        return increases
+
+    def rating_shift_impacts(self, steps=(-1, 1)):
+        """ Finds how the probability of bipartisan control moves if the
+        rating of each race alone shifts along RATING_SCALE (negative steps
+        toward R), for every race and step in one pass over the baseline:
+        the probability of success is linear in each race's win probability,
+        so each change is exact.
+
+        Arguments:
+            steps (optional): rating steps to evaluate
+        Output: DataFrame with one row per race (indexed as races, with its
+            state, office and district if known) and, for each step, the
+            shifted rating, its margin and the change in the probability of
+            bipartisan control (NaN past either end of the scale)
+        """
+
+        # find the shifted rating of every race for every step
+        positions = [rating_position(favored, confidence) for
+                     favored, confidence in zip(self.races['favored'],
+                                                self.races['confidence'])]
+        positions = np.asarray([np.nan if i is None else i for i in
+                                positions])
+        shifted = []
+        for step in steps:
+            new_positions = positions + step
+            valid = (new_positions >= 0) & (new_positions < len(RATING_SCALE))
+            race = self.races[valid].copy()
+            race['favored'] = [RATING_SCALE[int(i)][0] for i in
+                               new_positions[valid]]
+            race['confidence'] = [RATING_SCALE[int(i)][1] for i in
+                                  new_positions[valid]]
+            race['step'] = step
+            race['race'] = np.flatnonzero(valid)
+            shifted.append(race)
+        shifted = pd.concat(shifted)
+
+        # find their margins (and blend them) as in the baseline
+        found_margin_col, found_clip = self.blending[:2]
+        if found_margin_col and found_clip:
+            shifted[found_margin_col] = \
+                shifted['unclipped_' + found_margin_col]
+        shifted = add_margins(shifted, self.margin_col,
+                              self.rating_to_margin_df, *self.blending)
+
+        # find every change in the probability of bipartisan control at once
+        races = shifted['race'].to_numpy()
+        margin_changes = shifted[self.margin_col].to_numpy() - \
+            self.races[self.margin_col].to_numpy()[races]
+        shifted['prob_change'] = self._increases(self.states, self.margins,
+                                                 races, margin_changes)
+
+        # one row per race, one set of columns per step
+        id_cols = [col for col in ['state', 'office', 'district'] if col in
+                   self.races.columns]
+        impacts = self.races[id_cols + ['favored', 'confidence',
+                                        self.margin_col]].copy()
+        for step in steps:
+            step_df = shifted[shifted['step'] == step]
+            name = '{:+d}'.format(step)
+            for col, new_col in [('favored', 'favored_'), ('confidence',
+                                  'confidence_'), (self.margin_col,
+                                  self.margin_col + '_'),
+                                 ('prob_change', 'prob_change_')]:
+                impacts[new_col + name] = step_df[col]
+        return impacts
+
+
+def rating_position(favored, confidence):
+    """ Position of a rating in RATING_SCALE (None if it is not on it, e.g.
+    uncontested or independent races).
+    """
+
+    if confidence == 'Toss-Up':
+        return RATING_SCALE.index((False, 'Toss-Up'))
+    if (favored, confidence) in RATING_SCALE:
+        return RATING_SCALE.index((favored, confidence))
+    return None
+
+
+def write_table(df, path):
+    """ Writes a DataFrame (without its index) to CSV, or to Parquet if path
+    ends in .parquet (which needs pyarrow or fastparquet installed).
+    """
+
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)